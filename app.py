@@ -1,5 +1,6 @@
 # app.py - Professional TTS Generator with User Management (Fixed Version)
 import asyncio
+import io
 import json
 import os
 import random
@@ -7,66 +8,317 @@ import re
 import time
 import uuid
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
-from contextlib import asynccontextmanager
+from typing import AsyncIterable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
 from fastapi import FastAPI, Request, Form, UploadFile, File, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import edge_tts
 from pydub import AudioSegment
-from pydub.effects import normalize, compress_dynamic_range
 import webvtt
 import natsort
+import numpy as np
 import uvicorn
 import glob
 import shutil
 import hashlib
 import secrets
-from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+import threading
+import zipfile
+import codecs
+import posixpath
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from html.parser import HTMLParser
+from urllib.parse import unquote
 
-# ==================== DATABASE SIMPLE (Using JSON files) ====================
+# ==================== DATABASE (SQLite) ====================
 class Database:
-    def __init__(self):
+    def __init__(self, db_file: str = None):
+        self.db_file = db_file or os.environ.get("TTS_DB_PATH", "tts.db")
+        # Legacy JSON stores, imported once on first start
         self.users_file = "users.json"
         self.sessions_file = "sessions.json"
+        self.lock = threading.RLock()
+        # Callbacks invoked with a username whenever that user's row is written
+        self.user_listeners = []
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
         self.init_db()
+        self.import_json_files()
+        self.index_existing_outputs()
     
     def init_db(self):
-        """Initialize database files"""
-        if not os.path.exists(self.users_file):
-            with open(self.users_file, 'w') as f:
-                json.dump({}, f)
+        """Initialize database schema"""
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("PRAGMA foreign_keys=ON")
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS users (
+                    username TEXT PRIMARY KEY,
+                    email TEXT,
+                    role TEXT NOT NULL DEFAULT 'user',
+                    plan TEXT NOT NULL DEFAULT 'free',
+                    created_at TEXT,
+                    data TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
+                CREATE INDEX IF NOT EXISTS idx_users_plan ON users(plan);
+                
+                CREATE TABLE IF NOT EXISTS sessions (
+                    token TEXT PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    last_activity TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_sessions_username ON sessions(username);
+                CREATE INDEX IF NOT EXISTS idx_sessions_created_at ON sessions(created_at);
+                
+                CREATE TABLE IF NOT EXISTS usage (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT NOT NULL,
+                    characters INTEGER NOT NULL,
+                    created_at TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_usage_username ON usage(username, created_at);
+                
+                CREATE TABLE IF NOT EXISTS outputs (
+                    file_id TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL UNIQUE,
+                    path TEXT NOT NULL,
+                    owner TEXT,
+                    size INTEGER NOT NULL,
+                    format TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    etag TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_outputs_owner ON outputs(owner, created_at);
+            """)
+            self._ensure_column("outputs", "etag", "TEXT")
+    
+    def _ensure_column(self, table: str, column: str, definition: str):
+        """Add a column to a table created by an older version"""
+        columns = [row["name"] for row in self.conn.execute(f"PRAGMA table_info({table})")]
+        if column not in columns:
+            self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    
+    @contextmanager
+    def transaction(self):
+        """Run statements in a single write transaction"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+            else:
+                self.conn.execute("COMMIT")
+    
+    def register_output(self, file_id: str, path: str, owner: Optional[str], output_format: str,
+                        etag: str = None) -> dict:
+        """Record a generated file in the output registry
+        
+        Without etag the file is not hashed here; ensure_output_etag() hashes
+        it on first download.
+        """
+        record = {
+            "file_id": file_id,
+            "filename": os.path.basename(path),
+            "path": path,
+            "owner": owner,
+            "size": os.path.getsize(path),
+            "format": output_format,
+            "created_at": datetime.now().isoformat(),
+            "etag": etag
+        }
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO outputs (file_id, filename, path, owner, size, format, created_at, etag) "
+                "VALUES (:file_id, :filename, :path, :owner, :size, :format, :created_at, :etag)",
+                record
+            )
+        return record
+    
+    @staticmethod
+    def hash_file(path: str) -> str:
+        """SHA-256 of a file's contents, used as its strong ETag"""
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    def ensure_output_etag(self, record: dict) -> str:
+        """Fill in the ETag of a record registered without one
+        
+        Hashing reads the whole file, so call it off the event loop.
+        """
+        if not record.get("etag"):
+            record["etag"] = self.hash_file(record["path"])
+            with self.transaction() as conn:
+                conn.execute(
+                    "UPDATE outputs SET etag = ? WHERE file_id = ?", (record["etag"], record["file_id"])
+                )
+        return record["etag"]
+    
+    def get_output(self, file_id: str):
+        """Get an output record by file id"""
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM outputs WHERE file_id = ?", (file_id,)).fetchone()
+        return dict(row) if row else None
+    
+    def list_outputs(self, owner: str = None, created_before: str = None) -> List[dict]:
+        """List output records, oldest first"""
+        query = "SELECT * FROM outputs WHERE 1 = 1"
+        params = []
+        if owner is not None:
+            query += " AND owner = ?"
+            params.append(owner)
+        if created_before is not None:
+            query += " AND created_at < ?"
+            params.append(created_before)
+        with self.lock:
+            rows = self.conn.execute(query + " ORDER BY created_at", params).fetchall()
+        return [dict(row) for row in rows]
+    
+    def output_bytes_by_owner(self) -> Dict[Optional[str], int]:
+        """Total registered output size per owner"""
+        with self.lock:
+            rows = self.conn.execute("SELECT owner, SUM(size) AS total FROM outputs GROUP BY owner").fetchall()
+        return {row["owner"]: row["total"] for row in rows}
+    
+    def delete_output(self, file_id: str):
+        """Remove an output record"""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM outputs WHERE file_id = ?", (file_id,))
+    
+    def get_output_by_filename(self, filename: str):
+        """Get an output record by file name"""
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM outputs WHERE filename = ?", (filename,)).fetchone()
+        return dict(row) if row else None
+    
+    def index_existing_outputs(self, outputs_dir: str = "outputs"):
+        """One-shot registration of files generated before the registry existed
+        
+        Their owner is unknown, so only admins can download them.
+        """
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM outputs LIMIT 1").fetchone():
+                return
+        if not os.path.isdir(outputs_dir):
+            return
+        
+        count = 0
+        for root, dirs, files in os.walk(outputs_dir):
+            for filename in files:
+                path = os.path.join(root, filename)
+                file_id, ext = os.path.splitext(filename)
+                # No hashing here; ETags are computed on first download
+                self.register_output(f"legacy_{file_id}", path, None, ext.lstrip("."))
+                count += 1
+        if count:
+            print(f"Indexed {count} existing output files")
+    
+    def import_json_files(self):
+        """One-shot import of the legacy users.json / sessions.json files"""
+        if os.path.exists(self.users_file):
+            try:
+                with open(self.users_file, 'r') as f:
+                    users = json.load(f)
+                with self.transaction() as conn:
+                    for user_data in users.values():
+                        self._write_user(conn, user_data, replace=False)
+                os.replace(self.users_file, f"{self.users_file}.imported")
+                print(f"Imported {len(users)} users from {self.users_file}")
+            except Exception as e:
+                print(f"Error importing {self.users_file}: {str(e)}")
         
-        if not os.path.exists(self.sessions_file):
-            with open(self.sessions_file, 'w') as f:
-                json.dump({}, f)
+        if os.path.exists(self.sessions_file):
+            try:
+                with open(self.sessions_file, 'r') as f:
+                    sessions = json.load(f)
+                with self.transaction() as conn:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO sessions (token, username, created_at, last_activity) "
+                        "VALUES (?, ?, ?, ?)",
+                        [
+                            (token, data["username"], data["created_at"],
+                             data.get("last_activity", data["created_at"]))
+                            for token, data in sessions.items()
+                        ]
+                    )
+                os.replace(self.sessions_file, f"{self.sessions_file}.imported")
+                print(f"Imported {len(sessions)} sessions from {self.sessions_file}")
+            except Exception as e:
+                print(f"Error importing {self.sessions_file}: {str(e)}")
+    
+    def _write_user(self, conn, user_data: dict, replace: bool = True):
+        """Insert or replace a user row"""
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        conn.execute(
+            f"{verb} INTO users (username, email, role, plan, created_at, data) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                user_data["username"],
+                user_data.get("email"),
+                user_data.get("role", "user"),
+                user_data.get("subscription", {}).get("plan", "free"),
+                user_data.get("created_at"),
+                json.dumps(user_data)
+            )
+        )
+        for listener in self.user_listeners:
+            listener(user_data["username"])
+    
+    def _read_user(self, conn, username: str):
+        """Read a single user row"""
+        row = conn.execute("SELECT data FROM users WHERE username = ?", (username,)).fetchone()
+        return json.loads(row["data"]) if row else None
     
     def load_users(self):
-        """Load users from file"""
-        try:
-            with open(self.users_file, 'r') as f:
-                return json.load(f)
-        except:
-            return {}
+        """Load all users"""
+        with self.lock:
+            rows = self.conn.execute("SELECT username, data FROM users").fetchall()
+        return {row["username"]: json.loads(row["data"]) for row in rows}
     
     def save_users(self, users):
-        """Save users to file"""
-        with open(self.users_file, 'w') as f:
-            json.dump(users, f, indent=2)
+        """Save users"""
+        with self.transaction() as conn:
+            for user_data in users.values():
+                self._write_user(conn, user_data)
     
     def load_sessions(self):
-        """Load sessions from file"""
-        try:
-            with open(self.sessions_file, 'r') as f:
-                return json.load(f)
-        except:
-            return {}
+        """Load all sessions"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT token, username, created_at, last_activity FROM sessions"
+            ).fetchall()
+        return {
+            row["token"]: {
+                "username": row["username"],
+                "created_at": row["created_at"],
+                "last_activity": row["last_activity"]
+            }
+            for row in rows
+        }
     
     def save_sessions(self, sessions):
-        """Save sessions to file"""
-        with open(self.sessions_file, 'w') as f:
-            json.dump(sessions, f, indent=2)
+        """Save sessions"""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO sessions (token, username, created_at, last_activity) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (token, data["username"], data["created_at"], data["last_activity"])
+                    for token, data in sessions.items()
+                ]
+            )
     
     def hash_password(self, password: str) -> str:
         """Hash password using SHA256 with salt"""
@@ -79,11 +331,6 @@ class Database:
     
     def create_user(self, username: str, password: str, email: str, full_name: str = ""):
         """Create new user"""
-        users = self.load_users()
-        
-        if username in users:
-            return False, "Username already exists"
-        
         user_data = {
             "username": username,
             "password": self.hash_password(password),
@@ -104,85 +351,103 @@ class Database:
             }
         }
         
-        users[username] = user_data
-        self.save_users(users)
+        with self.transaction() as conn:
+            if self._read_user(conn, username):
+                return False, "Username already exists"
+            self._write_user(conn, user_data)
         return True, "User created successfully"
     
     def authenticate_user(self, username: str, password: str):
         """Authenticate user"""
-        users = self.load_users()
+        user_data = self.get_user(username)
         
-        if username not in users:
+        if not user_data:
             return None
         
-        user_data = users[username]
         if self.verify_password(password, user_data["password"]):
             return user_data
         return None
     
     def create_session(self, username: str) -> str:
         """Create session token"""
-        sessions = self.load_sessions()
         session_token = secrets.token_urlsafe(32)
+        now = datetime.now().isoformat()
         
-        session_data = {
-            "username": username,
-            "created_at": datetime.now().isoformat(),
-            "last_activity": datetime.now().isoformat()
-        }
-        
-        sessions[session_token] = session_data
-        self.save_sessions(sessions)
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO sessions (token, username, created_at, last_activity) VALUES (?, ?, ?, ?)",
+                (session_token, username, now, now)
+            )
         return session_token
     
     def validate_session(self, session_token: str):
         """Validate session token"""
-        sessions = self.load_sessions()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT username, created_at FROM sessions WHERE token = ?", (session_token,)
+            ).fetchone()
         
-        if session_token not in sessions:
+        if not row:
             return None
         
-        session_data = sessions[session_token]
         # Check if session is expired (24 hours)
-        created_at = datetime.fromisoformat(session_data["created_at"])
+        created_at = datetime.fromisoformat(row["created_at"])
         if datetime.now() - created_at > timedelta(hours=24):
-            del sessions[session_token]
-            self.save_sessions(sessions)
+            self.delete_session(session_token)
             return None
         
         # Update last activity
-        session_data["last_activity"] = datetime.now().isoformat()
-        sessions[session_token] = session_data
-        self.save_sessions(sessions)
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE sessions SET last_activity = ? WHERE token = ?",
+                (datetime.now().isoformat(), session_token)
+            )
         
-        return session_data["username"]
+        return row["username"]
+    
+    def get_session(self, session_token: str):
+        """Get session data without touching last_activity"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT username, created_at, last_activity FROM sessions WHERE token = ?",
+                (session_token,)
+            ).fetchone()
+        return dict(row) if row else None
+    
+    def touch_sessions(self, activity: Dict[str, str]):
+        """Batch-update last_activity for many sessions"""
+        if not activity:
+            return
+        with self.transaction() as conn:
+            conn.executemany(
+                "UPDATE sessions SET last_activity = ? WHERE token = ?",
+                [(last_activity, token) for token, last_activity in activity.items()]
+            )
     
     def delete_session(self, session_token: str):
         """Delete session"""
-        sessions = self.load_sessions()
-        if session_token in sessions:
-            del sessions[session_token]
-            self.save_sessions(sessions)
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM sessions WHERE token = ?", (session_token,))
     
     def get_user(self, username: str):
         """Get user data"""
-        users = self.load_users()
-        return users.get(username)
+        with self.lock:
+            return self._read_user(self.conn, username)
     
     def update_user(self, username: str, user_data: dict):
         """Update user data"""
-        users = self.load_users()
-        if username in users:
-            users[username] = user_data
-            self.save_users(users)
-            return True
-        return False
+        with self.transaction() as conn:
+            if not self._read_user(conn, username):
+                return False
+            self._write_user(conn, user_data)
+        return True
     
     def record_usage(self, username: str, characters_used: int):
         """Record usage for user"""
-        users = self.load_users()
-        if username in users:
-            user_data = users[username]
+        with self.transaction() as conn:
+            user_data = self._read_user(conn, username)
+            if not user_data:
+                return
             
             # Reset weekly usage if needed
             last_reset = datetime.fromisoformat(user_data["usage"]["last_reset"])
@@ -194,16 +459,18 @@ class Database:
             user_data["usage"]["characters_used"] += characters_used
             user_data["usage"]["total_requests"] += 1
             
-            users[username] = user_data
-            self.save_users(users)
+            self._write_user(conn, user_data)
+            conn.execute(
+                "INSERT INTO usage (username, characters, created_at) VALUES (?, ?, ?)",
+                (username, characters_used, datetime.now().isoformat())
+            )
     
     def can_user_use_feature(self, username: str, feature: str) -> Tuple[bool, str]:
         """Check if user can use a feature"""
-        users = self.load_users()
-        if username not in users:
+        user_data = self.get_user(username)
+        if not user_data:
             return False, "User not found"
         
-        user_data = users[username]
         subscription = user_data["subscription"]
         
         # Check if feature is allowed in subscription
@@ -228,12 +495,6 @@ class Database:
     
     def update_subscription(self, username: str, plan: str, days: int = 30):
         """Update user subscription"""
-        users = self.load_users()
-        if username not in users:
-            return False
-        
-        user_data = users[username]
-        
         if plan == "free":
             features = ["single"]
             char_limit = 30000
@@ -246,21 +507,24 @@ class Database:
         else:
             return False
         
-        user_data["subscription"] = {
-            "plan": plan,
-            "expires_at": (datetime.now() + timedelta(days=days)).isoformat(),
-            "characters_limit": char_limit,
-            "features": features
-        }
-        
-        users[username] = user_data
-        self.save_users(users)
+        with self.transaction() as conn:
+            user_data = self._read_user(conn, username)
+            if not user_data:
+                return False
+            
+            user_data["subscription"] = {
+                "plan": plan,
+                "expires_at": (datetime.now() + timedelta(days=days)).isoformat(),
+                "characters_limit": char_limit,
+                "features": features
+            }
+            
+            self._write_user(conn, user_data)
         return True
     
     def init_admin_user(self):
         """Initialize admin user if not exists"""
-        users = self.load_users()
-        if "admin" not in users:
+        if not self.get_user("admin"):
             admin_user = {
                 "username": "admin",
                 "password": self.hash_password("admin123"),
@@ -280,13 +544,252 @@ class Database:
                     "total_requests": 0
                 }
             }
-            users["admin"] = admin_user
-            self.save_users(users)
+            with self.transaction() as conn:
+                self._write_user(conn, admin_user, replace=False)
 
 # Initialize database
 database = Database()
 database.init_admin_user()
 
+# ==================== SESSION CACHE ====================
+class SessionCache:
+    """LRU/TTL cache resolving session tokens to users in memory
+    
+    last_activity updates are kept in memory and written back to the
+    database in batches by run_flusher().
+    """
+    MAX_ENTRIES = int(os.environ.get("TTS_SESSION_CACHE_SIZE", 10000))
+    # Seconds a cached user record is trusted before re-reading it
+    USER_TTL = int(os.environ.get("TTS_SESSION_USER_TTL", 60))
+    FLUSH_INTERVAL = int(os.environ.get("TTS_SESSION_FLUSH_INTERVAL", 30))
+    SESSION_LIFETIME = timedelta(hours=24)
+    
+    def __init__(self, db: Database, max_entries: int = None):
+        self.db = db
+        self.max_entries = max_entries or self.MAX_ENTRIES
+        self.sessions: "OrderedDict[str, dict]" = OrderedDict()
+        self.dirty: Dict[str, str] = {}
+        self.lock = threading.Lock()
+        db.user_listeners.append(self.invalidate_user)
+    
+    def resolve(self, session_token: str):
+        """Resolve a session token to its user, or None"""
+        with self.lock:
+            entry = self.sessions.get(session_token)
+            if entry:
+                self.sessions.move_to_end(session_token)
+        
+        if not entry:
+            session_data = self.db.get_session(session_token)
+            if not session_data:
+                return None
+            entry = {
+                "username": session_data["username"],
+                "created_at": datetime.fromisoformat(session_data["created_at"]),
+                "user": None,
+                "loaded_at": 0.0
+            }
+        
+        now = datetime.now()
+        if now - entry["created_at"] > self.SESSION_LIFETIME:
+            self.forget(session_token)
+            self.db.delete_session(session_token)
+            return None
+        
+        if entry["user"] is None or time.monotonic() - entry["loaded_at"] > self.USER_TTL:
+            entry["user"] = self.db.get_user(entry["username"])
+            entry["loaded_at"] = time.monotonic()
+            if entry["user"] is None:
+                self.forget(session_token)
+                return None
+        
+        with self.lock:
+            self.sessions[session_token] = entry
+            self.sessions.move_to_end(session_token)
+            self.dirty[session_token] = now.isoformat()
+            while len(self.sessions) > self.max_entries:
+                self.sessions.popitem(last=False)
+        
+        return entry["user"]
+    
+    def invalidate_user(self, username: str):
+        """Drop cached copies of a user's record"""
+        with self.lock:
+            for entry in self.sessions.values():
+                if entry["username"] == username:
+                    entry["user"] = None
+    
+    def forget(self, session_token: str):
+        """Remove a session from the cache"""
+        with self.lock:
+            self.sessions.pop(session_token, None)
+            self.dirty.pop(session_token, None)
+    
+    def flush(self):
+        """Write pending last_activity updates to the database"""
+        with self.lock:
+            pending, self.dirty = self.dirty, {}
+        try:
+            self.db.touch_sessions(pending)
+        except Exception as e:
+            print(f"Error flushing sessions: {str(e)}")
+            with self.lock:
+                for token, last_activity in pending.items():
+                    self.dirty.setdefault(token, last_activity)
+    
+    async def run_flusher(self):
+        """Periodically flush last_activity updates"""
+        while True:
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            self.flush()
+
+session_cache = SessionCache(database)
+
+# ==================== USAGE LEDGER ====================
+class UsageLedger:
+    """Reserve/commit/refund accounting of characters against plan quotas
+    
+    Quota checks run against in-memory counters (committed usage plus
+    outstanding reservations) under one lock, so concurrent requests cannot
+    jointly overshoot a limit. Only commits reach the database, each one
+    journaled as a usage row in the same transaction that updates the user.
+    """
+    # Reservations whose job never settled are released after this many seconds
+    RESERVATION_TTL = int(os.environ.get("TTS_RESERVATION_TTL", 6 * 3600))
+    
+    def __init__(self, db: Database):
+        self.db = db
+        self.lock = threading.RLock()
+        self.accounts: Dict[str, dict] = {}
+        self.reserved: Dict[str, int] = {}
+        self.reservations: Dict[str, dict] = {}
+        self.last_expiry = time.monotonic()
+        self.commits = 0
+        self.refunds = 0
+        self.refunded_characters = 0
+        db.user_listeners.append(self.invalidate_user)
+    
+    def invalidate_user(self, username: str):
+        """Reload a user's counters on next use"""
+        with self.lock:
+            self.accounts.pop(username, None)
+    
+    def _account(self, username: str) -> Optional[dict]:
+        account = self.accounts.get(username)
+        if account is None:
+            user_data = self.db.get_user(username)
+            if not user_data:
+                return None
+            account = {
+                "subscription": user_data["subscription"],
+                "used": user_data["usage"]["characters_used"],
+                "last_reset": datetime.fromisoformat(user_data["usage"]["last_reset"])
+            }
+            self.accounts[username] = account
+        
+        # The weekly window rolled over; record_usage persists the reset on next commit
+        if datetime.now() - account["last_reset"] > timedelta(days=7):
+            account["used"] = 0
+        return account
+    
+    def _release(self, reservation: dict):
+        username = reservation["username"]
+        remaining = self.reserved.get(username, 0) - reservation["characters"]
+        if remaining > 0:
+            self.reserved[username] = remaining
+        else:
+            self.reserved.pop(username, None)
+    
+    def _expire(self):
+        if time.monotonic() - self.last_expiry < 60:
+            return
+        self.last_expiry = time.monotonic()
+        cutoff = time.time() - self.RESERVATION_TTL
+        for reservation_id, reservation in list(self.reservations.items()):
+            if reservation["created_at"] < cutoff:
+                del self.reservations[reservation_id]
+                self._release(reservation)
+    
+    def reserve(self, username: str, feature: str, characters: int) -> Tuple[Optional[str], str]:
+        """Check access and hold characters against the user's quota
+        
+        Returns (reservation_id, message); reservation_id is None if refused.
+        """
+        with self.lock:
+            self._expire()
+            account = self._account(username)
+            if not account:
+                return None, "User not found"
+            
+            subscription = account["subscription"]
+            if feature not in subscription["features"]:
+                return None, f"Feature '{feature}' requires premium subscription"
+            
+            # Weekly character limit for free tier, counting requests still in flight
+            if subscription["plan"] == "free":
+                held = account["used"] + self.reserved.get(username, 0)
+                if held + characters > subscription["characters_limit"]:
+                    remaining = max(0, subscription["characters_limit"] - held)
+                    return None, (
+                        f"Weekly character limit reached ({remaining} characters left). "
+                        "Please upgrade to premium."
+                    )
+            
+            if datetime.now() > datetime.fromisoformat(subscription["expires_at"]):
+                return None, "Subscription expired. Please renew."
+            
+            reservation_id = uuid.uuid4().hex
+            self.reservations[reservation_id] = {
+                "username": username,
+                "characters": characters,
+                "created_at": time.time()
+            }
+            self.reserved[username] = self.reserved.get(username, 0) + characters
+            return reservation_id, "Access granted"
+    
+    def commit(self, reservation_id: str, characters: int = None) -> int:
+        """Charge a reservation, refunding any part not given in characters
+        
+        Returns the number of characters charged.
+        """
+        with self.lock:
+            reservation = self.reservations.pop(reservation_id, None)
+            if not reservation:
+                return 0
+            self._release(reservation)
+            
+            charged = reservation["characters"]
+            if characters is not None:
+                charged = max(0, min(characters, charged))
+            self.db.record_usage(reservation["username"], charged)
+            
+            self.commits += 1
+            self.refunded_characters += reservation["characters"] - charged
+            return charged
+    
+    def refund(self, reservation_id: str) -> int:
+        """Release a reservation without charging it"""
+        with self.lock:
+            reservation = self.reservations.pop(reservation_id, None)
+            if not reservation:
+                return 0
+            self._release(reservation)
+            self.refunds += 1
+            self.refunded_characters += reservation["characters"]
+            return reservation["characters"]
+    
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "reservations": len(self.reservations),
+                "reserved_characters": sum(self.reserved.values()),
+                "commits": self.commits,
+                "refunds": self.refunds,
+                "refunded_characters": self.refunded_characters
+            }
+
+usage_ledger = UsageLedger(database)
+
 # ==================== AUTHENTICATION MIDDLEWARE ====================
 async def get_current_user(request: Request):
     """Get current user from session"""
@@ -294,11 +797,7 @@ async def get_current_user(request: Request):
     if not session_token:
         return None
     
-    username = database.validate_session(session_token)
-    if not username:
-        return None
-    
-    return database.get_user(username)
+    return session_cache.resolve(session_token)
 
 async def require_login(request: Request):
     """Require user to be logged in"""
@@ -786,6 +1285,7 @@ class TTSConfig:
             "name": "Free",
             "price": "$0",
             "characters_per_week": 30000,
+            "scheduler_weight": 1,
             "features": ["Single Voice TTS", "Basic Audio Effects", "30000 characters/week"],
             "limitations": ["No Multi-Voice", "No Q&A Dialogue", "Weekly limit"]
         },
@@ -793,6 +1293,7 @@ class TTSConfig:
             "name": "Premium",
             "price": "$9.99/month",
             "characters_per_month": 1000000,
+            "scheduler_weight": 2,
             "features": ["All Voices", "Multi-Voice TTS", "Q&A Dialogue", "1M characters/month"],
             "limitations": ["Monthly subscription"]
         },
@@ -800,17 +1301,237 @@ class TTSConfig:
             "name": "Pro",
             "price": "$29.99/month",
             "characters_per_month": "Unlimited",
+            "scheduler_weight": 4,
             "features": ["Unlimited Characters", "All Features", "Priority Support"],
             "limitations": []
         }
     }
 
+# ==================== VOICE CATALOG ====================
+class VoiceCatalog:
+    """Indexed voice list loaded from edge-tts, falling back to the bundled snapshot
+    
+    TTSConfig.LANGUAGES is the offline snapshot. Voices are indexed by name,
+    language, locale and gender, and /api responses are serialized once per
+    catalog version and served with an ETag.
+    """
+    # Seconds between reloads of the live voice list
+    REFRESH_INTERVAL = int(os.environ.get("TTS_VOICE_REFRESH", 24 * 3600))
+    LOAD_TIMEOUT = float(os.environ.get("TTS_VOICE_LOAD_TIMEOUT", 15))
+    GENDER_LABELS = {"Female": "👩Female", "Male": "🤵Male"}
+    
+    def __init__(self):
+        snapshot = self.from_languages(TTSConfig.LANGUAGES)
+        self.snapshot = {voice["name"]: voice for voice in snapshot}
+        self.source = "snapshot"
+        self.loaded_at = None
+        self.build(snapshot)
+    
+    @staticmethod
+    def locale_of(voice_name: str) -> str:
+        return "-".join(voice_name.split("-")[:2])
+    
+    @staticmethod
+    def gender_key(gender: str) -> str:
+        gender = gender.lower()
+        if "female" in gender:
+            return "female"
+        if "male" in gender:
+            return "male"
+        return gender
+    
+    @classmethod
+    def from_languages(cls, languages: Dict[str, List[dict]]) -> List[dict]:
+        """Flatten a TTSConfig.LANGUAGES-style dict into voice records"""
+        return [
+            {**voice, "locale": cls.locale_of(voice["name"]), "language": language}
+            for language, voices in languages.items()
+            for voice in voices
+        ]
+    
+    @classmethod
+    def from_edge_voices(cls, raw_voices: List[dict], snapshot: Dict[str, dict]) -> List[dict]:
+        """Convert edge_tts.list_voices() entries into voice records
+        
+        Languages and display names follow the snapshot where it knows the
+        locale or voice, so the UI keeps its familiar labels.
+        """
+        locale_languages = {}
+        for voice in snapshot.values():
+            locale_languages.setdefault(voice["locale"], voice["language"])
+        language_rank = {}
+        for voice in snapshot.values():
+            language_rank.setdefault(voice["language"], len(language_rank))
+        
+        voices = []
+        for raw in raw_voices:
+            name = raw.get("ShortName")
+            if not name:
+                continue
+            locale = raw.get("Locale") or cls.locale_of(name)
+            known = snapshot.get(name)
+            
+            language = locale_languages.get(locale)
+            if not language:
+                # "Microsoft Guy Online (Natural) - English (United States)"
+                friendly = raw.get("FriendlyName", "")
+                language = friendly.rsplit(" - ", 1)[1] if " - " in friendly else locale
+            
+            if known:
+                display = known["display"]
+            else:
+                base = name.split("-", 2)[-1].replace("Neural", "") or name
+                display = f"{base} ({locale})"
+            
+            voices.append({
+                "name": name,
+                "gender": cls.GENDER_LABELS.get(raw.get("Gender"), raw.get("Gender", "")),
+                "display": display,
+                "locale": locale,
+                "language": language
+            })
+        
+        voices.sort(key=lambda voice: (language_rank.get(voice["language"], len(language_rank)),
+                                       voice["language"]))
+        return voices
+    
+    def build(self, voices: List[dict]):
+        """Rebuild the indexes and cached responses from voice records"""
+        by_name = {}
+        by_language: Dict[str, List[dict]] = {}
+        by_locale: Dict[str, List[dict]] = {}
+        by_gender: Dict[str, List[dict]] = {}
+        for voice in voices:
+            by_name[voice["name"]] = voice
+            by_language.setdefault(voice["language"], []).append(voice)
+            by_locale.setdefault(voice["locale"].lower(), []).append(voice)
+            by_gender.setdefault(self.gender_key(voice["gender"]), []).append(voice)
+        
+        # Swap everything in at once so readers never see a half-built catalog
+        self.voices = voices
+        self.by_name = by_name
+        self.by_language = by_language
+        self.by_locale = by_locale
+        self.by_gender = by_gender
+        self.responses = {
+            "languages": self.serialize({"languages": list(by_language)}),
+            "empty": self.serialize({"voices": []}),
+            ("voices", None, None, None): self.serialize({"voices": voices})
+        }
+        for language, language_voices in by_language.items():
+            self.responses[("voices", language, None, None)] = self.serialize({"voices": language_voices})
+    
+    @staticmethod
+    def serialize(payload: dict) -> Tuple[bytes, str]:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        return body, hashlib.sha256(body).hexdigest()
+    
+    @property
+    def languages(self) -> Dict[str, List[dict]]:
+        """Voices grouped by language, in TTSConfig.LANGUAGES form"""
+        return self.by_language
+    
+    def get(self, voice_name: str) -> Optional[dict]:
+        return self.by_name.get(voice_name)
+    
+    def has_voice(self, voice_name: str) -> bool:
+        return voice_name in self.by_name
+    
+    def find(self, language: str = None, locale: str = None, gender: str = None) -> List[dict]:
+        """Voices matching every given filter"""
+        candidates = self.voices
+        if language:
+            candidates = self.by_language.get(language, [])
+        if locale:
+            names = {voice["name"] for voice in self.by_locale.get(locale.lower(), [])}
+            candidates = [voice for voice in candidates if voice["name"] in names]
+        if gender:
+            gender = self.gender_key(gender)
+            candidates = [voice for voice in candidates if self.gender_key(voice["gender"]) == gender]
+        return candidates
+    
+    def voices_response(self, language: str = None, locale: str = None, gender: str = None) -> Tuple[bytes, str]:
+        """Serialized /api/voices body and its ETag
+        
+        Unknown languages fall back to the full list, as before.
+        """
+        if language not in self.by_language:
+            language = None
+        locale = locale.lower() if locale else None
+        gender = self.gender_key(gender) if gender else None
+        # Only known filter values are memoized, so junk queries cannot grow the cache
+        if (locale and locale not in self.by_locale) or (gender and gender not in self.by_gender):
+            return self.responses["empty"]
+        
+        key = ("voices", language, locale, gender)
+        response = self.responses.get(key)
+        if response is None:
+            response = self.responses[key] = self.serialize({"voices": self.find(*key[1:])})
+        return response
+    
+    def languages_response(self) -> Tuple[bytes, str]:
+        return self.responses["languages"]
+    
+    async def refresh(self) -> bool:
+        """Load the live voice list, keeping the current catalog on failure"""
+        try:
+            raw_voices = await asyncio.wait_for(edge_tts.list_voices(), self.LOAD_TIMEOUT)
+            voices = self.from_edge_voices(raw_voices, self.snapshot)
+        except Exception as e:
+            print(f"Voice catalog refresh failed, keeping {self.source} voices: {str(e)}")
+            return False
+        
+        if not voices:
+            return False
+        self.build(voices)
+        self.source = "edge-tts"
+        self.loaded_at = datetime.now().isoformat()
+        return True
+    
+    async def run_refresher(self):
+        """Load the live voice list now and then periodically"""
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.REFRESH_INTERVAL)
+    
+    def stats(self) -> dict:
+        return {
+            "source": self.source,
+            "loaded_at": self.loaded_at,
+            "voices": len(self.voices),
+            "languages": len(self.by_language)
+        }
+
+voice_catalog = VoiceCatalog()
+
 # ==================== TEXT PROCESSOR ====================
+class TextChunk(NamedTuple):
+    """A piece of text sent to edge-tts in one request"""
+    text: str
+    start: int  # offset of the chunk in the source text
+    end: int
+
 class TextProcessor:
+    # Chunks grow up to TARGET_CHARS by merging sentences and are never longer than MAX_CHARS
+    TARGET_CHARS = int(os.environ.get("TTS_CHUNK_TARGET_CHARS", 300))
+    MAX_CHARS = int(os.environ.get("TTS_CHUNK_MAX_CHARS", 1000))
+    
+    # Sentence ends: Latin terminators need trailing whitespace, CJK/Arabic/Devanagari
+    # full stops do not; blank lines are paragraph breaks and never merged across
+    SENTENCE_BOUNDARY = re.compile(
+        r"\n\s*\n"
+        r"|[.!?…]+[\"'”’»)\]]*(?:\s+|$)"
+        r"|[。！？؟۔।]+[\"'”’」』)\]]*\s*"
+        r"|\n"
+    )
+    # Preferred places to hard-split an over-long sentence
+    CLAUSE_BOUNDARY = re.compile(r"[,;:，；、،]\s*|\s+")
+    
     @staticmethod
     def count_characters(text: str) -> int:
         """Count characters in text (excluding spaces)"""
-        return len(text.replace(" ", "").replace("\n", "").replace("\t", ""))
+        # Counting avoids building stripped copies of large texts
+        return len(text) - text.count(" ") - text.count("\n") - text.count("\t")
     
     @staticmethod
     def clean_text(text: str) -> str:
@@ -819,154 +1540,2775 @@ class TextProcessor:
         text = re.sub(r'\n+', '\n', text)
         return text.strip()
     
-    @staticmethod
-    def split_sentences(text: str) -> List[str]:
-        """Split text into sentences"""
-        sentences = []
-        for line in text.split('\n'):
-            stripped = line.strip()
-            if stripped:
-                sentences.append(stripped)
-        return sentences
+    @classmethod
+    def split_spans(cls, text: str, max_chars: int) -> List[Tuple[int, int, bool]]:
+        """Sentence spans as (start, end, ends_paragraph), hard-split at max_chars"""
+        spans = []
+        position = 0
+        
+        for match in cls.SENTENCE_BOUNDARY.finditer(text):
+            if match.end() == position:
+                continue
+            spans.append((position, match.end(), match.group().count("\n") > 1))
+            position = match.end()
+        if position < len(text):
+            spans.append((position, len(text), False))
+        
+        result = []
+        for start, end, paragraph_end in spans:
+            # Trim surrounding whitespace so offsets point at real text
+            while start < end and text[start].isspace():
+                start += 1
+            while end > start and text[end - 1].isspace():
+                end -= 1
+            if start == end:
+                if result and paragraph_end:
+                    result[-1] = (result[-1][0], result[-1][1], True)
+                continue
+            
+            while end - start > max_chars:
+                cut = start + max_chars
+                split_at = None
+                for clause in cls.CLAUSE_BOUNDARY.finditer(text, start + max_chars // 2, cut):
+                    split_at = clause.end()
+                piece_end = split_at or cut
+                start_next = piece_end
+                while piece_end > start and text[piece_end - 1].isspace():
+                    piece_end -= 1
+                result.append((start, piece_end, False))
+                start = start_next
+                while start < end and text[start].isspace():
+                    start += 1
+            if start < end:
+                result.append((start, end, paragraph_end))
+        
+        return result
+    
+    @classmethod
+    def chunk_text(cls, text: str, target_chars: int = None, max_chars: int = None,
+                   base_offset: int = 0) -> List[TextChunk]:
+        """Split text into synthesis chunks
+        
+        Sentences are detected across scripts (Latin, Vietnamese, CJK, Arabic,
+        Devanagari punctuation), short ones are merged up to target_chars
+        within a paragraph and long ones are split at max_chars. Chunk offsets
+        are relative to text plus base_offset.
+        """
+        target_chars = target_chars or cls.TARGET_CHARS
+        max_chars = max(target_chars, max_chars or cls.MAX_CHARS)
+        
+        chunks = []
+        current = None
+        
+        for start, end, paragraph_end in cls.split_spans(text, max_chars):
+            if current and end - current[0] <= target_chars:
+                current = (current[0], end)
+            else:
+                if current:
+                    chunks.append(current)
+                current = (start, end)
+            if paragraph_end:
+                chunks.append(current)
+                current = None
+        if current:
+            chunks.append(current)
+        
+        return [
+            TextChunk(re.sub(r"\s+", " ", text[start:end]), start + base_offset, end + base_offset)
+            for start, end in chunks
+        ]
 
-# ==================== TTS PROCESSOR ====================
-class TTSProcessor:
+# ==================== DOCUMENT READER ====================
+class HTMLTextParser(HTMLParser):
+    """Collects the text of (X)HTML block elements as paragraphs"""
+    BLOCK_TAGS = {
+        "p", "div", "li", "blockquote", "pre", "h1", "h2", "h3", "h4", "h5", "h6",
+        "dt", "dd", "td", "th", "caption", "section", "article", "br", "hr"
+    }
+    SKIP_TAGS = {"head", "script", "style"}
+    
     def __init__(self):
-        self.text_processor = TextProcessor()
-        self.initialize_directories()
+        super().__init__(convert_charrefs=True)
+        self.paragraphs = []
+        self.parts = []
+        self.skip_depth = 0
     
-    def initialize_directories(self):
-        """Initialize necessary directories"""
-        directories = ["outputs", "temp", "static", "templates"]
-        for directory in directories:
-            os.makedirs(directory, exist_ok=True)
+    def flush(self):
+        text = "".join(self.parts).strip()
+        self.parts = []
+        if text:
+            self.paragraphs.append(text)
     
-    async def generate_speech(self, text: str, voice_id: str, rate: int = 0, pitch: int = 0, volume: int = 100):
-        """Generate speech using edge-tts"""
-        try:
-            unique_id = uuid.uuid4().hex[:8]
-            rate_str = f"{rate}%" if rate != 0 else "+0%"
-            pitch_str = f"+{pitch}Hz" if pitch >= 0 else f"{pitch}Hz"
-            
-            communicate = edge_tts.Communicate(
-                text, 
-                voice_id, 
-                rate=rate_str, 
-                pitch=pitch_str
-            )
-            
-            audio_chunks = []
-            
-            async for chunk in communicate.stream():
-                if chunk["type"] == "audio":
-                    audio_chunks.append(chunk["data"])
-            
-            if not audio_chunks:
-                return None
-            
-            audio_data = b"".join(audio_chunks)
-            temp_file = f"temp/audio_{unique_id}_{int(time.time())}.mp3"
-            
-            with open(temp_file, "wb") as f:
-                f.write(audio_data)
-            
-            return temp_file
-            
-        except Exception as e:
-            print(f"Error generating speech: {str(e)}")
-            return None
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.flush()
     
-    async def process_single_voice(self, text: str, voice_id: str, rate: int, pitch: int, 
-                                 volume: int, pause: int, output_format: str = "mp3"):
-        """Process text with single voice"""
-        # Clean up old temp files
-        self.cleanup_temp_files()
+    def handle_startendtag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self.flush()
+    
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.flush()
+    
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+class DocumentReader:
+    """Reads uploaded .txt, .docx and .epub documents paragraph by paragraph
+    
+    Files are parsed incrementally from disk, so only the paragraph being
+    read is held in memory. Chunk offsets refer to the document text with
+    paragraphs separated by a blank line.
+    """
+    FORMATS = (".txt", ".docx", ".epub")
+    MAX_UPLOAD_BYTES = int(os.environ.get("TTS_UPLOAD_MAX_BYTES", 100 * 1024 * 1024))
+    BLOCK_SIZE = 64 * 1024
+    # Text without paragraph breaks is cut at a line or word break past this size
+    MAX_PARAGRAPH_CHARS = 64 * 1024
+    PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+    WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+    
+    @classmethod
+    def save_upload(cls, source, path: str) -> int:
+        """Copy an upload to path in blocks, returning its size
         
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_dir = f"outputs/single_{timestamp}"
-        os.makedirs(output_dir, exist_ok=True)
+        Raises ValueError if it is larger than MAX_UPLOAD_BYTES.
+        """
+        size = 0
+        with open(path, "wb") as f:
+            for block in iter(lambda: source.read(cls.BLOCK_SIZE), b""):
+                size += len(block)
+                if size > cls.MAX_UPLOAD_BYTES:
+                    raise ValueError(f"File is larger than {cls.MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+                f.write(block)
+        return size
+    
+    @classmethod
+    def paragraphs(cls, path: str) -> Iterator[str]:
+        """Yield the paragraphs of the document at path
         
-        sentences = self.text_processor.split_sentences(text)
+        Raises ValueError if the file is not a readable document.
+        """
+        extension = os.path.splitext(path)[1].lower()
+        if extension == ".txt":
+            yield from cls.text_paragraphs(path)
+            return
+        if extension not in cls.FORMATS:
+            raise ValueError("Upload a .txt, .docx or .epub file")
         
-        audio_segments = []
+        try:
+            with zipfile.ZipFile(path) as archive:
+                if extension == ".docx":
+                    yield from cls.docx_paragraphs(archive)
+                else:
+                    yield from cls.epub_paragraphs(archive)
+        except (zipfile.BadZipFile, KeyError, ET.ParseError):
+            raise ValueError(f"Invalid {extension} file")
+    
+    @classmethod
+    def text_paragraphs(cls, path: str) -> Iterator[str]:
+        with open(path, "r", encoding="utf-8-sig", errors="replace") as f:
+            buffer = ""
+            for block in iter(lambda: f.read(cls.BLOCK_SIZE), ""):
+                parts = cls.PARAGRAPH_BREAK.split(buffer + block)
+                # The last part may continue in the next block
+                buffer = parts.pop()
+                for paragraph in parts:
+                    if paragraph.strip():
+                        yield paragraph
+                
+                if len(buffer) > cls.MAX_PARAGRAPH_CHARS:
+                    cut = max(buffer.rfind("\n"), buffer.rfind(" ")) + 1 or len(buffer)
+                    if buffer[:cut].strip():
+                        yield buffer[:cut]
+                    buffer = buffer[cut:]
+            if buffer.strip():
+                yield buffer
+    
+    @classmethod
+    def docx_paragraphs(cls, archive: zipfile.ZipFile) -> Iterator[str]:
+        w = cls.WORD_NAMESPACE
+        parts = []
+        with archive.open("word/document.xml") as document:
+            for _, element in ET.iterparse(document, events=("end",)):
+                if element.tag == f"{w}t":
+                    parts.append(element.text or "")
+                elif element.tag == f"{w}tab":
+                    parts.append("\t")
+                elif element.tag in (f"{w}br", f"{w}cr"):
+                    parts.append("\n")
+                elif element.tag == f"{w}p":
+                    text = "".join(parts).strip()
+                    parts = []
+                    # Drop the parsed runs so memory does not grow with the document
+                    element.clear()
+                    if text:
+                        yield text
+    
+    @classmethod
+    def epub_paragraphs(cls, archive: zipfile.ZipFile) -> Iterator[str]:
+        container = ET.fromstring(archive.read("META-INF/container.xml"))
+        package_path = next(
+            (element.get("full-path") for element in container.iter() if element.tag.endswith("rootfile")),
+            None
+        )
+        if not package_path:
+            raise KeyError("rootfile")
+        package = ET.fromstring(archive.read(package_path))
+        hrefs = {
+            element.get("id"): element.get("href")
+            for element in package.iter() if element.tag.endswith("}item")
+        }
         
-        for sentence in sentences:
-            temp_file = await self.generate_speech(sentence, voice_id, rate, pitch, volume)
-            
-            if temp_file:
-                try:
-                    audio = AudioSegment.from_file(temp_file)
-                    audio_segments.append(audio)
-                    
-                    try:
-                        os.remove(temp_file)
-                    except:
-                        pass
-                except Exception as e:
-                    print(f"Error processing audio segment: {str(e)}")
+        # Chapters are read in spine (reading) order
+        for itemref in (element for element in package.iter() if element.tag.endswith("}itemref")):
+            href = hrefs.get(itemref.get("idref"))
+            if not href:
+                continue
+            chapter_path = posixpath.normpath(posixpath.join(posixpath.dirname(package_path), unquote(href)))
+            parser = HTMLTextParser()
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            with archive.open(chapter_path) as chapter:
+                for block in iter(lambda: chapter.read(cls.BLOCK_SIZE), b""):
+                    parser.feed(decoder.decode(block))
+                    yield from parser.paragraphs
+                    parser.paragraphs = []
+            parser.feed(decoder.decode(b"", final=True))
+            parser.close()
+            parser.flush()
+            yield from parser.paragraphs
+    
+    @classmethod
+    def chunks(cls, path: str) -> Iterator[TextChunk]:
+        """Yield synthesis chunks of the document at path as it is read"""
+        offset = 0
+        for paragraph in cls.paragraphs(path):
+            # Chunks never span paragraphs, so chunking each one on its own is exact
+            yield from TextProcessor.chunk_text(paragraph, base_offset=offset)
+            offset += len(paragraph) + 2
+    
+    @classmethod
+    def count_characters(cls, path: str) -> int:
+        """Billable characters in the document at path, read in one pass"""
+        return sum(TextProcessor.count_characters(paragraph) for paragraph in cls.paragraphs(path))
+
+# ==================== MP3 UTILITIES ====================
+def expand_pauses(pause, count: int) -> List[int]:
+    """Gap lengths in ms between count segments; pause is one value or a list"""
+    if isinstance(pause, (list, tuple)):
+        gaps = [int(gap) for gap in pause][:max(0, count - 1)]
+        return gaps + [0] * (max(0, count - 1) - len(gaps))
+    return [int(pause)] * max(0, count - 1)
+
+class MP3Utils:
+    """Helpers for working with MPEG audio Layer III frames directly"""
+    BITRATES = {
+        1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+        2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+    }
+    SAMPLE_RATES = {
+        1: [44100, 48000, 32000],
+        2: [22050, 24000, 16000],
+        2.5: [11025, 12000, 8000]
+    }
+    # Header of edge-tts' default audio-24khz-48kbitrate-mono-mp3 output
+    DEFAULT_HEADER = b"\xff\xf3\x64\xc4"
+    
+    @classmethod
+    def parse_header(cls, data: bytes, offset: int = 0) -> Optional[dict]:
+        """Parse a Layer III frame header at offset, or return None"""
+        if offset + 4 > len(data) or data[offset] != 0xFF or (data[offset + 1] & 0xE0) != 0xE0:
+            return None
         
-        if not audio_segments:
+        b1, b2, b3 = data[offset + 1], data[offset + 2], data[offset + 3]
+        version = {0: 2.5, 2: 2, 3: 1}.get((b1 >> 3) & 0x03)
+        layer = (b1 >> 1) & 0x03
+        bitrate_index = (b2 >> 4) & 0x0F
+        sample_rate_index = (b2 >> 2) & 0x03
+        if version is None or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
             return None
         
-        # Combine audio segments
-        combined = AudioSegment.empty()
-        for i, audio in enumerate(audio_segments):
-            combined += audio
-            if i < len(audio_segments) - 1:
-                combined += AudioSegment.silent(duration=pause)
+        bitrate = cls.BITRATES[1 if version == 1 else 2][bitrate_index] * 1000
+        sample_rate = cls.SAMPLE_RATES[version][sample_rate_index]
+        padding = (b2 >> 1) & 0x01
+        channels = 1 if (b3 >> 6) == 3 else 2
         
-        file_id = uuid.uuid4().hex
-        output_file = os.path.join(
-            output_dir,
-            f"single_voice_{file_id}.{output_format}"
-        )
-        combined.export(output_file, format=output_format, bitrate="192k")
-
+        if version == 1:
+            samples = 1152
+            frame_length = 144 * bitrate // sample_rate + padding
+            side_info = 17 if channels == 1 else 32
+        else:
+            samples = 576
+            frame_length = 72 * bitrate // sample_rate + padding
+            side_info = 9 if channels == 1 else 17
         
-        return output_file
+        return {
+            "version": version,
+            "bitrate": bitrate,
+            "sample_rate": sample_rate,
+            "channels": channels,
+            "samples": samples,
+            "frame_length": frame_length,
+            "side_info": side_info,
+            "protected": not (b1 & 0x01),
+            "header": bytes(data[offset:offset + 4])
+        }
     
-    def cleanup_temp_files(self):
-        """Clean temporary files"""
-        try:
-            temp_files = glob.glob("temp/*.mp3")
-            for file in temp_files:
-                try:
-                    if os.path.exists(file):
-                        os.remove(file)
-                except:
-                    pass
-        except Exception as e:
-            print(f"Error cleaning temp files: {str(e)}")
-
-# ==================== LIFESPAN MANAGER ====================
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """Lifespan event handler"""
-    print("Starting up TTS Generator with User Management...")
+    @classmethod
+    def find_header(cls, data: bytes) -> Optional[dict]:
+        """Find the first frame header in data"""
+        offset = data.find(b"\xff")
+        while offset != -1:
+            header = cls.parse_header(data, offset)
+            if header:
+                return header
+            offset = data.find(b"\xff", offset + 1)
+        return None
     
-    global tts_processor
-    tts_processor = TTSProcessor()
+    @classmethod
+    def silent_frame(cls, reference: bytes = None) -> bytes:
+        """Build a silent frame matching a reference frame header
+        
+        A frame whose side info and main data are all zero decodes to silence.
+        """
+        reference = reference or cls.DEFAULT_HEADER
+        # No CRC, no padding, otherwise identical to the reference
+        header = bytes([0xFF, reference[1] | 0x01, reference[2] & ~0x02 & 0xFF, reference[3]])
+        frame_length = cls.parse_header(header)["frame_length"]
+        return header + bytes(frame_length - 4)
     
-    # Cleanup old files
-    tts_processor.cleanup_temp_files()
+    @classmethod
+    def silence(cls, duration_ms: int, reference: bytes = None) -> bytes:
+        """Pre-encoded silence of roughly duration_ms"""
+        if duration_ms <= 0:
+            return b""
+        frame = cls.silent_frame(reference)
+        return frame * cls.silence_frame_count(duration_ms, cls.parse_header(frame))
     
-    # Create template files
-    create_template_files()
+    @staticmethod
+    def silence_frame_count(duration_ms: int, info: dict) -> int:
+        """Number of frames silence() emits for duration_ms"""
+        if duration_ms <= 0:
+            return 0
+        return max(1, round(duration_ms * info["sample_rate"] / (1000 * info["samples"])))
     
-    yield
+    @classmethod
+    def duration_ms(cls, data: bytes) -> float:
+        """Playing time of the audio frames in data"""
+        samples = 0
+        sample_rate = None
+        for _, header in cls.iter_frames(data):
+            samples += header["samples"]
+            sample_rate = header["sample_rate"]
+        return samples * 1000 / sample_rate if sample_rate else 0.0
     
-    print("Shutting down TTS Generator...")
-    tts_processor.cleanup_temp_files()
-
-# ==================== FASTAPI APPLICATION ====================
-app = FastAPI(
-    title="Professional TTS Generator with User Management", 
+    @classmethod
+    def iter_frames(cls, data: bytes):
+        """Yield (offset, header) for each complete audio frame in data
+        
+        Leading ID3v2 tags, junk between frames and existing Xing/Info
+        frames are skipped.
+        """
+        offset = 0
+        if data[:3] == b"ID3" and len(data) >= 10:
+            size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+            offset = 10 + size
+        
+        length = len(data)
+        while offset + 4 <= length:
+            header = cls.parse_header(data, offset)
+            if not header:
+                offset += 1
+                continue
+            end = offset + header["frame_length"]
+            if end > length:
+                break
+            tag_offset = offset + 4 + header["side_info"]
+            if data[tag_offset:tag_offset + 4] not in (b"Xing", b"Info"):
+                yield offset, header
+            offset = end
+    
+    @classmethod
+    def xing_frame(cls, reference: dict, frame_count: int, byte_count: int,
+                   toc: List[int] = None, vbr: bool = True) -> bytes:
+        """Build a Xing/Info header frame describing the stream that follows"""
+        tag = b"Xing" if vbr else b"Info"
+        flags = 0x03 | (0x04 if toc else 0)
+        payload = tag + flags.to_bytes(4, "big") + frame_count.to_bytes(4, "big") + byte_count.to_bytes(4, "big")
+        if toc:
+            payload += bytes(toc)
+        
+        # Use the smallest bitrate whose frame can hold the tag
+        b1, b2, b3 = reference["header"][1] | 0x01, reference["header"][2] & 0x0C, reference["header"][3]
+        for bitrate_index in range(1, 15):
+            header = bytes([0xFF, b1, (bitrate_index << 4) | b2, b3])
+            info = cls.parse_header(header)
+            if info["frame_length"] >= 4 + info["side_info"] + len(payload):
+                frame = header + bytes(info["side_info"]) + payload
+                return frame + bytes(info["frame_length"] - len(frame))
+        
+        return b""
+    
+    @classmethod
+    def concat(cls, segments: List[bytes], pause_ms=0, segment_ranges: list = None) -> bytes:
+        """Splice MP3 segments frame by frame with silent frames between them
+        
+        pause_ms is either one gap length or a list with the gap after each
+        segment. Raises ValueError if the segments do not share sample rate, channel
+        count and MPEG version, since those cannot be mixed in one stream.
+        If segment_ranges is given, the (start, end) byte range of each
+        segment's frames in the result is appended to it, or None for
+        segments without frames.
+        """
+        gaps = expand_pauses(pause_ms, len(segments))
+        reference = None
+        silent_frame_length = 0
+        parts = []
+        frame_offsets = []
+        bitrates = set()
+        position = 0
+        
+        ranges = []
+        for index, data in enumerate(segments):
+            frames = list(cls.iter_frames(data))
+            if not frames:
+                ranges.append(None)
+                continue
+            
+            if reference is None:
+                reference = frames[0][1]
+                silent_frame_length = len(cls.silent_frame(reference["header"]))
+            
+            silence = cls.silence(gaps[index - 1], reference["header"]) if parts else b""
+            if silence:
+                for start in range(0, len(silence), silent_frame_length):
+                    frame_offsets.append(position + start)
+                parts.append(silence)
+                position += len(silence)
+            
+            segment_start = position
+            for offset, header in frames:
+                if (header["sample_rate"], header["channels"], header["version"]) != (
+                        reference["sample_rate"], reference["channels"], reference["version"]):
+                    raise ValueError("MP3 segments have mismatched stream parameters")
+                bitrates.add(header["bitrate"])
+                frame_offsets.append(position)
+                parts.append(data[offset:offset + header["frame_length"]])
+                position += header["frame_length"]
+            ranges.append((segment_start, position))
+        
+        if reference is None:
+            return b""
+        
+        body = b"".join(parts)
+        frame_count = len(frame_offsets)
+        
+        # The tag frame size does not depend on its contents, so build it twice:
+        # once to learn its length, then with the final byte count and TOC.
+        tag_length = len(cls.xing_frame(reference, frame_count, len(body), [0] * 100))
+        byte_count = tag_length + len(body)
+        toc = [
+            min(255, (tag_length + frame_offsets[i * frame_count // 100]) * 256 // byte_count)
+            for i in range(100)
+        ]
+        tag = cls.xing_frame(reference, frame_count, byte_count, toc, vbr=len(bitrates) > 1)
+        
+        if segment_ranges is not None:
+            for segment_range in ranges:
+                segment_ranges.append(
+                    (len(tag) + segment_range[0], len(tag) + segment_range[1]) if segment_range else None
+                )
+        return tag + body
+
+# ==================== PCM ASSEMBLER ====================
+class PCMAssembler:
+    """Assemble decoded segments into one preallocated PCM buffer"""
+    
+    @staticmethod
+    def assemble(segments: List[AudioSegment], pause) -> AudioSegment:
+        """Join segments with pause ms of silence between them
+        
+        pause is either one gap length or a list with the gap after each segment.
+        The output size is computed up front and each segment is copied into
+        place exactly once, so assembly is linear in the output length.
+        Entries of segments are released as they are copied.
+        """
+        if not segments:
+            return AudioSegment.empty()
+        
+        reference = segments[0]
+        frame_rate, channels, sample_width = reference.frame_rate, reference.channels, reference.sample_width
+        
+        for i, segment in enumerate(segments):
+            if (segment.frame_rate, segment.channels, segment.sample_width) != (frame_rate, channels, sample_width):
+                segments[i] = segment.set_frame_rate(frame_rate).set_channels(channels).set_sample_width(sample_width)
+        
+        frame_width = channels * sample_width
+        gap_bytes = [int(frame_rate * max(0, gap) / 1000) * frame_width for gap in expand_pauses(pause, len(segments))]
+        gap_bytes.append(0)
+        total_bytes = sum(len(segment.raw_data) for segment in segments) + sum(gap_bytes)
+        
+        # Zero bytes are silence for signed PCM, so the gaps need no writes
+        buffer = bytearray(total_bytes)
+        view = memoryview(buffer)
+        position = 0
+        
+        for i in range(len(segments)):
+            raw_data = segments[i].raw_data
+            view[position:position + len(raw_data)] = raw_data
+            position += len(raw_data) + gap_bytes[i]
+            segments[i] = None
+        
+        return AudioSegment(
+            data=buffer,
+            sample_width=sample_width,
+            frame_rate=frame_rate,
+            channels=channels
+        )
+
+# ==================== AUDIO EFFECTS ====================
+class AudioEffects(NamedTuple):
+    """Post-processing applied to the assembled output
+    
+    volume is a percentage (100 leaves the level unchanged), fades are in ms.
+    """
+    volume: int = 100
+    normalize: bool = False
+    compress: bool = False
+    fade_in: int = 0
+    fade_out: int = 0
+    
+    @classmethod
+    def from_params(cls, volume=100, normalize=False, compress=False, fade_in=0, fade_out=0) -> "AudioEffects":
+        """Validate request parameters, raising ValueError if out of range"""
+        volume, fade_in, fade_out = int(volume), int(fade_in), int(fade_out)
+        if not 0 <= volume <= 200:
+            raise ValueError("volume must be between 0 and 200")
+        if not (0 <= fade_in <= 10000 and 0 <= fade_out <= 10000):
+            raise ValueError("Fades must be between 0 and 10000 ms")
+        return cls(volume, bool(normalize), bool(compress), fade_in, fade_out)
+    
+    @property
+    def active(self) -> bool:
+        return self.volume != 100 or self.normalize or self.compress or self.fade_in > 0 or self.fade_out > 0
+
+class EffectsProcessor:
+    """Vectorized gain, loudness normalization, compression and fades on PCM
+    
+    Every effect is a handful of NumPy operations over the whole buffer, so
+    cost stays linear in the output length.
+    """
+    # Integrated loudness that normalization aims for
+    LOUDNESS_TARGET = float(os.environ.get("TTS_LOUDNESS_TARGET", -16))
+    COMPRESS_THRESHOLD_DB = -20.0
+    COMPRESS_RATIO = 4.0
+    # Envelope block and gain smoothing window for the compressor, in ms
+    COMPRESS_BLOCK_MS = 10
+    COMPRESS_SMOOTH_MS = 50
+    DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+    
+    @classmethod
+    def loudness(cls, samples: np.ndarray, frame_rate: int) -> Optional[float]:
+        """Approximate integrated loudness in LUFS
+        
+        Uses the BS.1770 gating scheme (400 ms blocks with 75% overlap, an
+        absolute gate at -70 LUFS and a relative gate 10 LU below) on the
+        unweighted signal; K-weighting is skipped, which for speech shifts
+        the result by about a decibel. Returns None for silent input.
+        """
+        step = max(1, int(frame_rate * 0.1))
+        steps = len(samples) // step
+        if steps == 0:
+            return None
+        
+        # Energy per 100 ms step; each 400 ms block is four consecutive steps
+        energy = np.square(samples[:steps * step]).reshape(steps, -1).sum(axis=1, dtype=np.float64)
+        if steps >= 4:
+            block_power = np.convolve(energy, np.ones(4), mode="valid") / (4 * step)
+        else:
+            block_power = np.array([energy.sum() / (steps * step)])
+        
+        with np.errstate(divide="ignore"):
+            block_loudness = -0.691 + 10 * np.log10(block_power)
+        gated = block_power[block_loudness > -70]
+        if not len(gated):
+            return None
+        relative_gate = -0.691 + 10 * np.log10(gated.mean()) - 10
+        with np.errstate(divide="ignore"):
+            gated = gated[-0.691 + 10 * np.log10(gated) > relative_gate]
+        return -0.691 + 10 * np.log10(gated.mean())
+    
+    @classmethod
+    def compressor_gain(cls, samples: np.ndarray, frame_rate: int) -> np.ndarray:
+        """Per-frame gain of a feed-forward compressor with a smoothed envelope"""
+        block = max(1, int(frame_rate * cls.COMPRESS_BLOCK_MS / 1000))
+        blocks = -(-len(samples) // block)
+        padded = np.zeros((blocks * block, samples.shape[1]), dtype=np.float32)
+        padded[:len(samples)] = samples
+        
+        rms = np.sqrt(np.square(padded).reshape(blocks, -1).mean(axis=1))
+        level_db = 20 * np.log10(np.maximum(rms, 1e-9))
+        over = np.maximum(level_db - cls.COMPRESS_THRESHOLD_DB, 0)
+        reduction_db = -over * (1 - 1 / cls.COMPRESS_RATIO)
+        
+        # Moving average stands in for attack/release smoothing
+        window = max(1, cls.COMPRESS_SMOOTH_MS // cls.COMPRESS_BLOCK_MS)
+        reduction_db = np.convolve(reduction_db, np.ones(window) / window, mode="same")
+        
+        gain = np.power(10, reduction_db / 20).astype(np.float32)
+        return np.repeat(gain, block)[:len(samples)]
+    
+    @classmethod
+    def apply(cls, audio: AudioSegment, effects: AudioEffects) -> AudioSegment:
+        """Return audio with effects applied
+        
+        Order: compression, loudness normalization, volume, fades, then a
+        hard clip to the sample range.
+        """
+        if not effects.active or len(audio.raw_data) == 0:
+            return audio
+        if audio.sample_width not in cls.DTYPES:
+            audio = audio.set_sample_width(2)
+        
+        dtype = cls.DTYPES[audio.sample_width]
+        full_scale = float(np.iinfo(dtype).max)
+        samples = np.frombuffer(audio.raw_data, dtype=dtype).reshape(-1, audio.channels)
+        samples = samples.astype(np.float32) / full_scale
+        frame_rate = audio.frame_rate
+        
+        if effects.compress:
+            samples *= cls.compressor_gain(samples, frame_rate)[:, None]
+        
+        gain = effects.volume / 100
+        if effects.normalize:
+            loudness = cls.loudness(samples, frame_rate)
+            if loudness is not None:
+                gain *= 10 ** ((cls.LOUDNESS_TARGET - loudness) / 20)
+        if gain != 1:
+            samples *= gain
+        
+        for fade_ms, fade_out in ((effects.fade_in, False), (effects.fade_out, True)):
+            frames = min(len(samples), int(frame_rate * fade_ms / 1000))
+            if frames > 0:
+                ramp = np.linspace(0.0, 1.0, frames, dtype=np.float32)[:, None]
+                if fade_out:
+                    samples[-frames:] *= ramp[::-1]
+                else:
+                    samples[:frames] *= ramp
+        
+        np.clip(samples * full_scale, np.iinfo(dtype).min, full_scale, out=samples)
+        return AudioSegment(
+            data=samples.astype(dtype).tobytes(),
+            sample_width=audio.sample_width,
+            frame_rate=frame_rate,
+            channels=audio.channels
+        )
+
+# ==================== METRICS ====================
+class Histogram:
+    """Cumulative-bucket histogram rendered in Prometheus text format"""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+    
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (), buckets=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets or self.BUCKETS))
+        self.series: Dict[tuple, list] = {}
+        self.lock = threading.Lock()
+    
+    def observe(self, value: float, *label_values):
+        """Record one observation for the given label values"""
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_values, (bucket_counts, total, count) in sorted(self.series.items()):
+                labels = list(zip(self.label_names, label_values))
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f"{self.name}_bucket{format_labels(labels + [('le', repr(float(bound)))])} {bucket_count}")
+                lines.append(f"{self.name}_bucket{format_labels(labels + [('le', '+Inf')])} {count}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+class Counter:
+    """Monotonic counter rendered in Prometheus text format"""
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.values: Dict[tuple, float] = {}
+        self.lock = threading.Lock()
+    
+    def inc(self, amount: float = 1, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(list(zip(self.label_names, label_values)))} {value}")
+        return lines
+
+def format_labels(labels: List[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+def render_metric(name: str, documentation: str, samples, metric_type: str = "gauge") -> List[str]:
+    """Render a value computed at scrape time, or a list of (labels, value) pairs"""
+    if not isinstance(samples, list):
+        samples = [([], samples)]
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        lines.append(f"{name}{format_labels(labels)} {float(value)}")
+    return lines
+
+class Metrics:
+    """Process-wide latency histograms and counters exported on /metrics"""
+    def __init__(self):
+        self.edge_tts_seconds = Histogram(
+            "tts_edge_tts_seconds", "Time to synthesize one sentence with edge-tts", ("outcome",)
+        )
+        self.edge_tts_first_audio_seconds = Histogram(
+            "tts_edge_tts_first_audio_seconds", "Time until edge-tts returned the first audio chunk"
+        )
+        self.outbound_wait_seconds = Histogram(
+            "tts_outbound_wait_seconds", "Time spent waiting for an outbound edge-tts slot"
+        )
+        self.audio_stage_seconds = Histogram(
+            "tts_audio_stage_seconds", "Time spent in each audio processing stage", ("pipeline", "stage")
+        )
+        self.audio_executor_wait_seconds = Histogram(
+            "tts_audio_executor_wait_seconds", "Time audio work waited for an executor worker"
+        )
+        self.job_seconds = Histogram(
+            "tts_job_seconds", "End-to-end job time from submission to completion", ("kind", "status")
+        )
+        self.bytes_served = Counter(
+            "tts_bytes_served_total", "Audio bytes sent to clients", ("route",)
+        )
+        self.failed_sentences = Counter(
+            "tts_failed_sentences_total", "Sentences that could not be synthesized after retries", ("pipeline",)
+        )
+    
+    def render(self) -> List[str]:
+        lines = []
+        for metric in (self.edge_tts_seconds, self.edge_tts_first_audio_seconds, self.outbound_wait_seconds,
+                       self.audio_stage_seconds, self.audio_executor_wait_seconds, self.job_seconds,
+                       self.bytes_served, self.failed_sentences):
+            lines.extend(metric.render())
+        return lines
+
+metrics = Metrics()
+
+# Stage timings recorded by the audio function currently running on this worker
+_stage_timings = threading.local()
+
+@contextmanager
+def timed_stage(pipeline: str, stage: str):
+    """Time a block of audio work; timings travel back with the executor result"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages = getattr(_stage_timings, "stages", None)
+        if stages is not None:
+            stages.append((pipeline, stage, time.perf_counter() - started))
+
+# ==================== AUDIO EXECUTOR ====================
+def splice_mp3(segments: List[bytes], pause, output_file: str) -> Optional[list]:
+    """Write segments as one MP3 by frame splicing, or return None if they can't be spliced
+    
+    Returns the byte range of each segment in output_file, as reported by
+    MP3Utils.concat().
+    """
+    segment_ranges = []
+    try:
+        with timed_stage("splice", "assemble"):
+            combined_data = MP3Utils.concat(segments, pause, segment_ranges)
+    except ValueError as e:
+        print(f"Falling back to re-encoding: {str(e)}")
+        return None
+    
+    if not combined_data:
+        return None
+    
+    with timed_stage("splice", "export"):
+        with open(output_file, "wb") as f:
+            f.write(combined_data)
+    return segment_ranges
+
+def render_audio(segments: List[bytes], pause, output_file: str, output_format: str,
+                 effects: AudioEffects = None) -> Optional[str]:
+    """Decode MP3 segments, assemble them, apply effects and export to output_file"""
+    gaps = expand_pauses(pause, len(segments))
+    audio_segments = []
+    kept_gaps = []
+    
+    with timed_stage("render", "decode"):
+        for index, audio_data in enumerate(segments):
+            try:
+                # Decode straight from memory, no temp file round trip
+                audio_segments.append(AudioSegment.from_file(io.BytesIO(audio_data), format="mp3"))
+                if len(audio_segments) > 1:
+                    kept_gaps.append(gaps[index - 1])
+            except Exception as e:
+                print(f"Error processing audio segment: {str(e)}")
+    
+    if not audio_segments:
+        return None
+    
+    with timed_stage("render", "assemble"):
+        combined = PCMAssembler.assemble(audio_segments, kept_gaps)
+    if effects and effects.active:
+        with timed_stage("render", "effects"):
+            combined = EffectsProcessor.apply(combined, effects)
+    with timed_stage("render", "export"):
+        combined.export(output_file, format=output_format, bitrate="192k")
+    return output_file
+
+def build_zip(members: List[Tuple[str, str]], manifest: dict, output_file: str) -> str:
+    """Write (path, arcname) members and manifest.json into a ZIP archive"""
+    with zipfile.ZipFile(output_file, "w", compression=zipfile.ZIP_STORED) as archive:
+        # Audio is already compressed, so members are stored as-is
+        for path, arcname in members:
+            archive.write(path, arcname)
+        archive.writestr("manifest.json", json.dumps(manifest, indent=2, ensure_ascii=False))
+    return output_file
+
+def _timed_call(fn, *args):
+    """Run fn in a worker and report when it started and finished, plus its stage timings"""
+    started_at = time.time()
+    _stage_timings.stages = []
+    try:
+        result = fn(*args)
+        return result, started_at, time.time(), _stage_timings.stages
+    finally:
+        _stage_timings.stages = None
+
+class AudioExecutor:
+    """Thread or process pool that all CPU-bound audio work runs on"""
+    MODE = os.environ.get("TTS_AUDIO_EXECUTOR", "thread")
+    WORKERS = int(os.environ.get("TTS_AUDIO_WORKERS", os.cpu_count() or 2))
+    
+    def __init__(self, mode: str = None, workers: int = None):
+        self.mode = (mode or self.MODE).lower()
+        self.workers = max(1, workers or self.WORKERS)
+        self.executor = None
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+    
+    def start(self):
+        """Create the worker pool"""
+        if self.executor:
+            return
+        if self.mode == "process":
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="audio")
+    
+    def shutdown(self):
+        """Stop the worker pool"""
+        if self.executor:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+    
+    async def run(self, fn, *args):
+        """Run fn(*args) on the pool without blocking the event loop
+        
+        In process mode fn and its arguments must be picklable.
+        """
+        self.start()
+        submitted_at = time.time()
+        self.pending += 1
+        try:
+            result, started_at, finished_at, stages = await asyncio.get_running_loop().run_in_executor(
+                self.executor, _timed_call, fn, *args
+            )
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+        
+        self.completed += 1
+        self.wait_seconds += max(0.0, started_at - submitted_at)
+        self.run_seconds += finished_at - started_at
+        metrics.audio_executor_wait_seconds.observe(max(0.0, started_at - submitted_at))
+        for pipeline, stage, seconds in stages:
+            metrics.audio_stage_seconds.observe(seconds, pipeline, stage)
+        return result
+    
+    def queue_depth(self) -> int:
+        """Jobs submitted but not yet picked up by a worker (approximate)"""
+        return max(0, self.pending - self.workers)
+    
+    def stats(self) -> dict:
+        """Executor counters"""
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "pending": self.pending,
+            "queue_depth": self.queue_depth(),
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_wait_seconds": round(self.wait_seconds / self.completed, 4) if self.completed else 0.0,
+            "avg_run_seconds": round(self.run_seconds / self.completed, 4) if self.completed else 0.0
+        }
+
+audio_executor = AudioExecutor()
+
+# ==================== SYNTHESIS CACHE ====================
+class SynthesisCache:
+    """Disk-backed, content-addressed cache of edge-tts output with LRU eviction
+    
+    Each entry is the MP3 plus an optional JSON sidecar with the word
+    boundaries reported while it was synthesized. Methods block on disk I/O
+    and are thread-safe, so async callers run them with asyncio.to_thread.
+    """
+    CACHE_DIR = os.environ.get("TTS_CACHE_DIR", "cache/tts")
+    MAX_BYTES = int(os.environ.get("TTS_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+    
+    def __init__(self, cache_dir: str = None, max_bytes: int = None):
+        self.cache_dir = cache_dir or self.CACHE_DIR
+        self.max_bytes = max_bytes if max_bytes is not None else self.MAX_BYTES
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.load_index()
+    
+    @staticmethod
+    def make_key(text: str, voice_id: str, rate: int, pitch: int) -> str:
+        """Hash the parameters that determine edge-tts output"""
+        payload = json.dumps([text, voice_id, int(rate), int(pitch)], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def path_for(self, key: str) -> str:
+        """Path of a cache entry"""
+        return os.path.join(self.cache_dir, key[:2], f"{key}.mp3")
+    
+    def boundaries_path_for(self, key: str) -> str:
+        """Path of a cache entry's boundary sidecar"""
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+    
+    def load_index(self):
+        """Rebuild the LRU index from files on disk, oldest first"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        found = []
+        for path in glob.glob(os.path.join(self.cache_dir, "*", "*.mp3")):
+            try:
+                stat = os.stat(path)
+                size = stat.st_size
+                sidecar = f"{path[:-4]}.json"
+                if os.path.exists(sidecar):
+                    size += os.path.getsize(sidecar)
+                found.append((stat.st_mtime, os.path.basename(path)[:-4], size))
+            except OSError:
+                pass
+        
+        with self.lock:
+            for _, key, size in sorted(found):
+                self.entries[key] = size
+                self.total_bytes += size
+        self.evict()
+    
+    def get(self, key: str) -> Optional[bytes]:
+        """Return cached audio or None"""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        
+        path = self.path_for(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Persist recency across restarts
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.total_bytes -= self.entries.pop(key, 0)
+                self.misses += 1
+            return None
+        
+        with self.lock:
+            self.hits += 1
+        return data
+    
+    def get_boundaries(self, key: str) -> Optional[list]:
+        """Return the cached word boundaries for key, or None if there are none"""
+        try:
+            with open(self.boundaries_path_for(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def put(self, key: str, data: bytes, boundaries: list = None):
+        """Store audio, and optionally its word boundaries, under key"""
+        sidecar = json.dumps(boundaries, ensure_ascii=False).encode("utf-8") if boundaries is not None else b""
+        size = len(data) + len(sidecar)
+        if size > self.max_bytes:
+            return
+        
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The sidecar goes first so an entry's audio never appears without it
+        files = [(self.boundaries_path_for(key), sidecar)] if boundaries is not None else []
+        files.append((path, data))
+        for target, content in files:
+            temp_path = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+            try:
+                with open(temp_path, "wb") as f:
+                    f.write(content)
+                os.replace(temp_path, target)
+            except OSError as e:
+                print(f"Error writing cache entry: {str(e)}")
+                try:
+                    os.remove(temp_path)
+                except:
+                    pass
+                return
+        
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+        self.evict()
+    
+    def evict(self):
+        """Remove least recently used entries until under max_bytes"""
+        while True:
+            with self.lock:
+                if self.total_bytes <= self.max_bytes or not self.entries:
+                    return
+                key, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+                self.evictions += 1
+            for path in (self.path_for(key), self.boundaries_path_for(key)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+    
+    def stats(self) -> dict:
+        """Cache counters"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+# ==================== SYNTHESIS RESILIENCE ====================
+class SynthesisError(Exception):
+    """Raised when edge-tts cannot produce audio for a piece of text"""
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+class CircuitBreaker:
+    """Fails edge-tts calls fast after repeated upstream failures
+    
+    After FAILURE_THRESHOLD consecutive failures the breaker opens and calls
+    are rejected until RESET_TIMEOUT has passed; then a single trial call is
+    let through and its outcome closes or re-opens the breaker.
+    """
+    FAILURE_THRESHOLD = int(os.environ.get("TTS_BREAKER_THRESHOLD", 5))
+    RESET_TIMEOUT = float(os.environ.get("TTS_BREAKER_RESET", 30))
+    
+    def __init__(self, failure_threshold: int = None, reset_timeout: float = None):
+        self.failure_threshold = max(1, failure_threshold or self.FAILURE_THRESHOLD)
+        self.reset_timeout = reset_timeout if reset_timeout is not None else self.RESET_TIMEOUT
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.trips = 0
+        self.rejected = 0
+    
+    def allow(self) -> bool:
+        """Return whether a call may be made now"""
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+            self.trial_in_flight = False
+        
+        if self.state == "half_open":
+            if self.trial_in_flight:
+                self.rejected += 1
+                return False
+            self.trial_in_flight = True
+        return True
+    
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.trial_in_flight = False
+    
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.trips += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+    
+    def release(self):
+        """Give up a trial call that ended without a verdict"""
+        self.trial_in_flight = False
+    
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected
+        }
+
+def generation_message(failed_chunks: list) -> str:
+    """Describe a finished generation, calling out any failed chunks"""
+    if failed_chunks:
+        return f"Audio generated with {len(failed_chunks)} failed chunk(s)"
+    return "Audio generated successfully"
+
+def failed_characters(failed_chunks: list) -> int:
+    """Characters in chunks that could not be synthesized"""
+    return sum(TextProcessor.count_characters(chunk["text"]) for chunk in failed_chunks)
+
+# ==================== OUTBOUND SCHEDULER ====================
+class OutboundScheduler:
+    """Rate-limits edge-tts sessions and shares them fairly between users
+    
+    A token bucket bounds how fast new sessions are opened and MAX_ACTIVE
+    bounds how many are open at once. When callers have to wait, slots are
+    handed out by start-time fair queuing: each request is tagged with a
+    virtual finish time that advances by 1/weight per session of its user,
+    and the waiting request with the smallest tag goes next, so higher plans
+    get a larger share while everyone keeps making progress.
+    """
+    # Sessions opened per second on average, and how many may be opened at once after a lull
+    RATE = float(os.environ.get("TTS_OUTBOUND_RATE", 10))
+    BURST = int(os.environ.get("TTS_OUTBOUND_BURST", 20))
+    MAX_ACTIVE = int(os.environ.get("TTS_OUTBOUND_CONCURRENCY", 16))
+    # Seconds a looked-up plan weight is reused
+    WEIGHT_TTL = 60
+    
+    def __init__(self, rate: float = None, burst: int = None, max_active: int = None):
+        self.rate = rate or self.RATE
+        self.burst = max(1, burst or self.BURST)
+        self.max_active = max(1, max_active or self.MAX_ACTIVE)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.active = 0
+        self.queues: Dict[str, deque] = {}
+        self.finish_tags: Dict[str, float] = {}
+        self.virtual_time = 0.0
+        self.weights: Dict[str, Tuple[float, float]] = {}
+        self.wakeup = None
+        self.granted = 0
+        self.waited = 0
+    
+    def weight_for(self, username: str) -> float:
+        """Scheduling weight of a user's subscription plan"""
+        if not username:
+            return 1.0
+        cached = self.weights.get(username)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        
+        weight = 1.0
+        user = database.get_user(username)
+        if user:
+            plan = user.get("subscription", {}).get("plan", "free")
+            weight = float(TTSConfig.SUBSCRIPTION_PLANS.get(plan, {}).get("scheduler_weight", 1))
+        self.weights[username] = (weight, time.monotonic() + self.WEIGHT_TTL)
+        return weight
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def _tag(self, key: str, weight: float) -> Tuple[float, float]:
+        """Assign start and finish virtual times to a new session request
+        
+        A user with requests already tagged continues from their last finish
+        time; one returning from idle starts at the current virtual time, so
+        idle periods do not bank credit.
+        """
+        start = max(self.finish_tags.get(key, 0.0), self.virtual_time)
+        finish = start + 1.0 / weight
+        self.finish_tags[key] = finish
+        return start, finish
+    
+    def _grant(self, start: float):
+        self.virtual_time = max(self.virtual_time, start)
+        self.tokens -= 1
+        self.active += 1
+        self.granted += 1
+    
+    def _dispatch(self):
+        """Grant free slots to waiting users in fair-share order"""
+        self.wakeup = None
+        while self.queues and self.active < self.max_active:
+            self._refill()
+            if self.tokens < 1:
+                delay = (1 - self.tokens) / self.rate
+                self.wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            
+            key = min(self.queues, key=lambda k: self.queues[k][0][2])
+            queue = self.queues[key]
+            future, start, _ = queue.popleft()
+            if not queue:
+                del self.queues[key]
+            if future.done():
+                continue
+            self._grant(start)
+            future.set_result(None)
+    
+    async def acquire(self, username: str = None):
+        """Wait for permission to open one edge-tts session"""
+        key = username or ""
+        start, finish = self._tag(key, self.weight_for(username))
+        
+        if not self.queues and self.active < self.max_active:
+            self._refill()
+            if self.tokens >= 1:
+                self._grant(start)
+                return
+        
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(key, deque()).append((future, start, finish))
+        self.waited += 1
+        if self.wakeup is None:
+            self._dispatch()
+        
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as we were cancelled: hand the slot back
+                self.release()
+            else:
+                future.cancel()
+            raise
+    
+    def release(self):
+        self.active -= 1
+        if self.queues and self.wakeup is None:
+            self._dispatch()
+    
+    @asynccontextmanager
+    async def slot(self, username: str = None):
+        await self.acquire(username)
+        try:
+            yield
+        finally:
+            self.release()
+    
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "max_active": self.max_active,
+            "waiting": sum(len(queue) for queue in self.queues.values()),
+            "waiting_users": len(self.queues),
+            "tokens": round(self.tokens, 2),
+            "granted": self.granted,
+            "waited": self.waited
+        }
+
+outbound_scheduler = OutboundScheduler()
+
+# ==================== SUBTITLES ====================
+class SubtitleBuilder:
+    """Lays edge-tts word boundaries out on the combined output timeline
+    
+    Boundary offsets are relative to their own segment, so each segment's
+    start time (its predecessors plus the pause gaps) is added to them.
+    """
+    MAX_CUE_CHARS = 80
+    MAX_CUE_MS = 5000
+    # A silence longer than this between two words starts a new cue
+    MAX_WORD_GAP_MS = 700
+    
+    @staticmethod
+    def timeline(segments: List[bytes], pause, spliced: bool) -> List[float]:
+        """Start of each segment in ms within the combined output
+        
+        Spliced MP3 output rounds each gap to whole silent frames, exactly as
+        MP3Utils.concat does; decoded output uses the gaps as given.
+        """
+        gaps = expand_pauses(pause, len(segments))
+        reference = None
+        starts = []
+        position = 0.0
+        for index, data in enumerate(segments):
+            duration = MP3Utils.duration_ms(data)
+            if starts and duration:
+                gap = gaps[index - 1]
+                if spliced:
+                    info = reference or MP3Utils.parse_header(MP3Utils.silent_frame())
+                    gap = MP3Utils.silence_frame_count(gap, info) * info["samples"] * 1000 / info["sample_rate"]
+                position += max(0, gap)
+            if reference is None:
+                reference = MP3Utils.find_header(data)
+            starts.append(position)
+            position += duration
+        return starts
+    
+    @classmethod
+    def build(cls, segments: List[bytes], pause, spliced: bool, boundaries: List[list],
+              speakers: List[str] = None) -> dict:
+        """Word timings and subtitle cues for the combined output, in seconds"""
+        words = []
+        cues = []
+        for index, start in enumerate(cls.timeline(segments, pause, spliced)):
+            speaker = speakers[index] if speakers else None
+            segment_words = sorted(
+                (boundary for boundary in boundaries[index] if boundary["type"] == "WordBoundary"),
+                key=lambda boundary: boundary["start"]
+            )
+            
+            cue = []
+            for boundary in segment_words:
+                word = {
+                    "text": boundary["text"],
+                    "start": round((start + boundary["start"]) / 1000, 3),
+                    "end": round((start + boundary["end"]) / 1000, 3),
+                    "segment": index
+                }
+                if speaker:
+                    word["speaker"] = speaker
+                words.append(word)
+                
+                if cue and (
+                    len(" ".join(w["text"] for w in cue)) + len(word["text"]) + 1 > cls.MAX_CUE_CHARS
+                    or (word["end"] - cue[0]["start"]) * 1000 > cls.MAX_CUE_MS
+                    or (word["start"] - cue[-1]["end"]) * 1000 > cls.MAX_WORD_GAP_MS
+                ):
+                    cues.append(cls.make_cue(cue, speaker))
+                    cue = []
+                cue.append(word)
+            if cue:
+                cues.append(cls.make_cue(cue, speaker))
+        
+        return {"words": words, "cues": cues}
+    
+    @staticmethod
+    def make_cue(words: List[dict], speaker: str = None) -> dict:
+        text = " ".join(word["text"] for word in words)
+        return {
+            "start": words[0]["start"],
+            "end": words[-1]["end"],
+            "text": f"{speaker}: {text}" if speaker else text
+        }
+    
+    @staticmethod
+    def timestamp(seconds: float) -> str:
+        milliseconds = int(round(seconds * 1000))
+        hours, milliseconds = divmod(milliseconds, 3600000)
+        minutes, milliseconds = divmod(milliseconds, 60000)
+        seconds, milliseconds = divmod(milliseconds, 1000)
+        return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}"
+
+def write_subtitles(timings: dict, base_path: str) -> List[str]:
+    """Write base_path.srt, .vtt and .json from SubtitleBuilder.build() output"""
+    vtt = webvtt.WebVTT()
+    for cue in timings["cues"]:
+        vtt.captions.append(webvtt.Caption(
+            SubtitleBuilder.timestamp(cue["start"]),
+            SubtitleBuilder.timestamp(cue["end"]),
+            cue["text"]
+        ))
+    
+    paths = [f"{base_path}.srt", f"{base_path}.vtt", f"{base_path}.json"]
+    vtt.save_as_srt(paths[0])
+    vtt.save(paths[1])
+    with open(paths[2], "w", encoding="utf-8") as f:
+        json.dump(timings, f, ensure_ascii=False)
+    return paths
+
+def subtitle_urls(audio_file: str) -> dict:
+    """Download URLs of the subtitle files written next to audio_file"""
+    base_path = os.path.splitext(audio_file)[0]
+    urls = {}
+    for key, extension in (("srt_url", "srt"), ("vtt_url", "vtt"), ("timings_url", "json")):
+        if os.path.exists(f"{base_path}.{extension}"):
+            urls[key] = f"/download/{os.path.basename(base_path)}.{extension}"
+    return urls
+
+# ==================== CHUNK MANIFESTS ====================
+class ChunkManifest:
+    """Record of the chunks a single-voice output was assembled from
+    
+    Saved as <audio>.manifest.json next to the output. Each chunk keeps its
+    synthesis cache key as its hash, its offsets in the source text, its word
+    boundaries and, for spliced MP3 output, the byte range of its frames in
+    the audio file. Edited text can then be rendered again by synthesizing
+    only the chunks whose hash is not in the manifest.
+    """
+    VERSION = 1
+    
+    @staticmethod
+    def path_for(audio_file: str) -> str:
+        return f"{os.path.splitext(audio_file)[0]}.manifest.json"
+    
+    @classmethod
+    def build(cls, params: dict, chunks: List[TextChunk], keys: List[str],
+              boundaries: Dict[int, list], audio_ranges: Dict[int, tuple]) -> dict:
+        """Manifest for chunks; audio_ranges maps chunk indexes to byte ranges"""
+        return {
+            "version": cls.VERSION,
+            **params,
+            "spliced": bool(audio_ranges),
+            "chunks": [
+                {
+                    "hash": keys[index],
+                    "start": chunk.start,
+                    "end": chunk.end,
+                    "audio": audio_ranges.get(index),
+                    "boundaries": boundaries.get(index, [])
+                }
+                for index, chunk in enumerate(chunks)
+            ]
+        }
+    
+    @classmethod
+    def load(cls, audio_file: str) -> Optional[dict]:
+        """Manifest of audio_file, or None if it has none"""
+        try:
+            with open(cls.path_for(audio_file), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return manifest if manifest.get("version") == cls.VERSION else None
+    
+    @staticmethod
+    def reusable(manifest: dict, keys: List[str]) -> List[Optional[dict]]:
+        """For each chunk hash, the manifest chunk whose audio can be cut from the output
+        
+        Re-encoded outputs (WAV or effects) cannot be cut, so nothing is reusable.
+        """
+        by_hash = {}
+        if manifest["spliced"]:
+            for entry in manifest["chunks"]:
+                if entry["audio"]:
+                    by_hash.setdefault(entry["hash"], entry)
+        return [by_hash.get(key) for key in keys]
+
+# ==================== TTS PROCESSOR ====================
+class TTSProcessor:
+    # Upper bound on edge-tts sessions one job may keep open at once
+    MAX_CONCURRENCY = int(os.environ.get("TTS_MAX_CONCURRENCY", 8))
+    # Extra attempts per sentence before it is reported as failed
+    SENTENCE_RETRIES = int(os.environ.get("TTS_SENTENCE_RETRIES", 2))
+    # Seconds one edge-tts call may spend waiting on the service in total
+    CALL_TIMEOUT = float(os.environ.get("TTS_CALL_TIMEOUT", 60))
+    # Seconds edge-tts may stay silent between two stream messages
+    IDLE_TIMEOUT = float(os.environ.get("TTS_IDLE_TIMEOUT", 15))
+    # Retry delays grow exponentially from BACKOFF_BASE up to BACKOFF_MAX
+    BACKOFF_BASE = float(os.environ.get("TTS_BACKOFF_BASE", 0.5))
+    BACKOFF_MAX = float(os.environ.get("TTS_BACKOFF_MAX", 8))
+    
+    # Temp job directories older than this are considered abandoned
+    TEMP_MAX_AGE = int(os.environ.get("TTS_TEMP_MAX_AGE", 3600))
+    
+    def __init__(self, max_concurrency: int = None, cache: SynthesisCache = None):
+        self.text_processor = TextProcessor()
+        self.max_concurrency = max(1, max_concurrency or self.MAX_CONCURRENCY)
+        self.initialize_directories()
+        self.cache = cache or SynthesisCache()
+        self.breaker = CircuitBreaker()
+        # Temp directories of running jobs, which the age sweep must not touch
+        self.active_temp_dirs = set()
+    
+    def initialize_directories(self):
+        """Initialize necessary directories"""
+        directories = ["outputs", "temp", "static", "templates"]
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+    
+    async def stream_speech(self, text: str, voice_id: str, rate: int = 0, pitch: int = 0,
+                            username: str = None, boundaries: list = None):
+        """Yield MP3 chunks for text as edge-tts produces them
+        
+        If boundaries is given, the word boundaries of the audio are appended
+        to it once synthesis completes, as dicts with type, text and start/end
+        in ms from the start of this audio.
+        """
+        cache_key = self.cache.make_key(text, voice_id, rate, pitch)
+        # Cache reads, writes and evictions touch the disk, so they run off the event loop
+        audio_data = await asyncio.to_thread(self.cache.get, cache_key)
+        if audio_data is not None and boundaries is not None:
+            cached_boundaries = await asyncio.to_thread(self.cache.get_boundaries, cache_key)
+            if cached_boundaries is None:
+                # Entry predates boundary caching; synthesize again to get timings
+                audio_data = None
+            else:
+                boundaries.extend(cached_boundaries)
+        if audio_data is not None:
+            yield audio_data
+            return
+        
+        # Cache hits never touch edge-tts, so only misses wait for a slot
+        wait_started = time.monotonic()
+        async with outbound_scheduler.slot(username):
+            metrics.outbound_wait_seconds.observe(time.monotonic() - wait_started)
+            if not self.breaker.allow():
+                raise SynthesisError("edge-tts is unavailable (circuit breaker open)", retryable=False)
+            
+            rate_str = f"{rate}%" if rate != 0 else "+0%"
+            pitch_str = f"+{pitch}Hz" if pitch >= 0 else f"{pitch}Hz"
+            
+            audio_chunks = []
+            word_boundaries = []
+            outcome = None
+            completed = False
+            stream = None
+            # Only time spent waiting on edge-tts counts against the budget,
+            # not time the consumer takes between chunks
+            budget = self.CALL_TIMEOUT
+            
+            try:
+                communicate = edge_tts.Communicate(
+                    text, 
+                    voice_id, 
+                    rate=rate_str, 
+                    pitch=pitch_str,
+                    boundary="WordBoundary"
+                )
+                stream = communicate.stream()
+                
+                while True:
+                    timeout = min(self.IDLE_TIMEOUT, budget)
+                    if timeout <= 0:
+                        raise asyncio.TimeoutError()
+                    started = time.monotonic()
+                    try:
+                        chunk = await asyncio.wait_for(stream.__anext__(), timeout)
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        budget -= time.monotonic() - started
+                    
+                    if chunk["type"] == "audio":
+                        if not audio_chunks:
+                            metrics.edge_tts_first_audio_seconds.observe(self.CALL_TIMEOUT - budget)
+                        audio_chunks.append(chunk["data"])
+                        yield chunk["data"]
+                    elif chunk["type"] in ("WordBoundary", "SentenceBoundary"):
+                        # Offsets and durations arrive in 100 ns ticks
+                        word_boundaries.append({
+                            "type": chunk["type"],
+                            "text": chunk["text"],
+                            "start": chunk["offset"] / 10000,
+                            "end": (chunk["offset"] + chunk["duration"]) / 10000
+                        })
+                
+                if not audio_chunks:
+                    outcome = "success"
+                    raise SynthesisError("edge-tts returned no audio")
+                outcome = "success"
+                completed = True
+                
+            except SynthesisError:
+                raise
+            except asyncio.TimeoutError:
+                outcome = "failure"
+                raise SynthesisError("edge-tts timed out")
+            except (ValueError, TypeError) as e:
+                # Bad voice or parameters: the service is fine and retrying cannot help
+                outcome = "success"
+                raise SynthesisError(f"edge-tts rejected the request: {str(e)}", retryable=False)
+            except edge_tts.exceptions.NoAudioReceived as e:
+                outcome = "success"
+                raise SynthesisError(f"edge-tts returned no audio: {str(e)}")
+            except Exception as e:
+                outcome = "failure"
+                raise SynthesisError(f"edge-tts error: {str(e)}")
+            finally:
+                metrics.edge_tts_seconds.observe(
+                    self.CALL_TIMEOUT - budget,
+                    "ok" if completed else "error" if outcome else "abandoned"
+                )
+                if outcome == "success":
+                    self.breaker.record_success()
+                elif outcome == "failure":
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.release()
+                if stream is not None:
+                    try:
+                        await stream.aclose()
+                    except Exception:
+                        pass
+            
+            # Only complete results reach the cache
+            await asyncio.to_thread(self.cache.put, cache_key, b"".join(audio_chunks), word_boundaries)
+            if boundaries is not None:
+                boundaries.extend(word_boundaries)
+    
+    async def generate_speech(self, text: str, voice_id: str, rate: int = 0, pitch: int = 0,
+                              volume: int = 100, username: str = None, boundaries: list = None) -> bytes:
+        """Generate speech using edge-tts, returning the MP3 bytes
+        
+        Raises SynthesisError if no audio could be produced. boundaries is
+        filled as in stream_speech().
+        """
+        audio_chunks = [
+            chunk async for chunk in self.stream_speech(text, voice_id, rate, pitch, username, boundaries)
+        ]
+        return b"".join(audio_chunks)
+    
+    def backoff_delay(self, attempt: int) -> float:
+        """Full-jitter exponential backoff before retry number attempt + 1"""
+        return random.uniform(0, min(self.BACKOFF_MAX, self.BACKOFF_BASE * (2 ** attempt)))
+    
+    async def generate_speech_with_retry(self, text: str, voice_id: str, rate: int = 0, pitch: int = 0,
+                                         volume: int = 100, retries: int = None,
+                                         username: str = None, boundaries: list = None) -> bytes:
+        """Generate speech for one sentence, retrying transient failures
+        
+        Raises the last SynthesisError once retries are exhausted.
+        """
+        if retries is None:
+            retries = self.SENTENCE_RETRIES
+        
+        for attempt in range(retries + 1):
+            try:
+                return await self.generate_speech(text, voice_id, rate, pitch, volume, username, boundaries)
+            except SynthesisError as e:
+                if not e.retryable or attempt >= retries:
+                    raise
+                print(f"Retrying sentence after error: {str(e)}")
+            await asyncio.sleep(self.backoff_delay(attempt))
+    
+    async def synthesize_sentences(self, sentences: Union[Iterable[str], AsyncIterable[str]], voice_id: str,
+                                   rate: int, pitch: int,
+                                   volume: int, max_concurrency: int = None,
+                                   progress_callback=None, failures: list = None,
+                                   username: str = None,
+                                   boundaries: Dict[int, list] = None) -> List[Optional[bytes]]:
+        """Synthesize sentences concurrently, returning results in input order
+        
+        sentences may be a lazy or async iterable; the next sentence is pulled
+        only when a synthesis slot frees up. progress_callback is called as
+        progress_callback(done, total), with total None unless sentences is a list.
+        Sentences that still fail after retries are None in the result and,
+        if failures is given, appended to it as {"index", "text", "error"}.
+        If boundaries is given, boundaries[index] receives the word
+        boundaries of each synthesized sentence.
+        """
+        semaphore = asyncio.Semaphore(max(1, max_concurrency or self.max_concurrency))
+        total = len(sentences) if isinstance(sentences, list) else None
+        completed = 0
+        
+        async def synthesize(index: int, sentence: str):
+            nonlocal completed
+            sentence_boundaries = [] if boundaries is not None else None
+            try:
+                result = await self.generate_speech_with_retry(
+                    sentence, voice_id, rate, pitch, volume, username=username,
+                    boundaries=sentence_boundaries
+                )
+                if boundaries is not None:
+                    boundaries[index] = sentence_boundaries
+            except SynthesisError as e:
+                print(f"Sentence {index} failed: {str(e)}")
+                metrics.failed_sentences.inc(1, "job")
+                if failures is not None:
+                    failures.append({"index": index, "text": sentence, "error": str(e)})
+                result = None
+            finally:
+                semaphore.release()
+            completed += 1
+            if progress_callback:
+                progress_callback(completed, total)
+            return result
+        
+        async def pull():
+            if hasattr(sentences, "__aiter__"):
+                async for sentence in sentences:
+                    yield sentence
+            else:
+                for sentence in sentences:
+                    yield sentence
+        
+        tasks = []
+        try:
+            index = 0
+            async for sentence in pull():
+                await semaphore.acquire()
+                tasks.append(asyncio.create_task(synthesize(index, sentence)))
+                index += 1
+            # gather() keeps results aligned with the input order
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        if failures is not None:
+            failures.sort(key=lambda failure: failure["index"])
+        return results
+    
+    async def process_single_voice(self, text: str, voice_id: str, rate: int, pitch: int, 
+                                 volume: int, pause: int, output_format: str = "mp3",
+                                 max_concurrency: int = None, progress_callback=None,
+                                 username: str = None, failed_chunks: list = None,
+                                 effects: AudioEffects = None, previous: Tuple[str, dict] = None):
+        """Process text with single voice
+        
+        progress_callback, if given, is called as progress_callback(percent, message).
+        effects defaults to applying just volume.
+        Chunks that could not be synthesized are left out of the audio and,
+        if failed_chunks is given, appended to it with their text offsets.
+        previous is an earlier (audio_file, manifest); chunks it already holds
+        are cut from that file instead of being synthesized.
+        Raises SynthesisError if no chunk could be synthesized.
+        """
+        effects = effects or AudioEffects(volume=volume)
+        chunks, keys, reused = self.plan_chunks(text, voice_id, rate, pitch, previous and previous[1])
+        
+        audio_results = [None] * len(chunks)
+        boundaries = {}
+        if any(reused):
+            with open(previous[0], "rb") as f:
+                for index, entry in enumerate(reused):
+                    if entry:
+                        start, end = entry["audio"]
+                        f.seek(start)
+                        audio_results[index] = f.read(end - start)
+                        boundaries[index] = entry["boundaries"]
+        pending = [index for index, entry in enumerate(reused) if not entry]
+        
+        def report_chunk(done: int, total: int):
+            if progress_callback:
+                progress_callback(int(done / total * 90), f"Synthesized chunk {done}/{total}")
+        
+        failures = []
+        pending_boundaries = {}
+        pending_results = await self.synthesize_sentences(
+            [chunks[index].text for index in pending], voice_id, rate, pitch, volume, max_concurrency,
+            report_chunk, failures, username, pending_boundaries
+        )
+        for position, index in enumerate(pending):
+            audio_results[index] = pending_results[position]
+            if position in pending_boundaries:
+                boundaries[index] = pending_boundaries[position]
+        for failure in failures:
+            failure["index"] = pending[failure["index"]]
+        
+        if failed_chunks is not None:
+            for failure in failures:
+                chunk = chunks[failure["index"]]
+                failed_chunks.append({
+                    "index": failure["index"],
+                    "start": chunk.start,
+                    "end": chunk.end,
+                    "text": chunk.text,
+                    "error": failure["error"]
+                })
+        
+        if chunks and len(failures) == len(chunks):
+            raise SynthesisError(f"All {len(chunks)} chunks failed: {failures[0]['error']}")
+        
+        if progress_callback:
+            progress_callback(90, "Combining audio...")
+        
+        kept = [index for index, audio_data in enumerate(audio_results) if audio_data]
+        segment_ranges = []
+        audio_file = await self.write_output(
+            [audio_results[index] for index in kept], pause, output_format, username, "single",
+            effects, [boundaries.get(index, []) for index in kept], segment_ranges=segment_ranges
+        )
+        if audio_file:
+            params = {
+                "voice_id": voice_id,
+                "rate": rate,
+                "pitch": pitch,
+                "volume": volume,
+                "pause": pause,
+                "output_format": output_format,
+                "effects": effects._asdict()
+            }
+            audio_ranges = {
+                index: segment_range for index, segment_range in zip(kept, segment_ranges) if segment_range
+            }
+            self.save_manifest(
+                audio_file, ChunkManifest.build(params, chunks, keys, boundaries, audio_ranges), username
+            )
+        return audio_file
+    
+    def plan_chunks(self, text: str, voice_id: str, rate: int, pitch: int,
+                    manifest: dict = None) -> Tuple[List[TextChunk], List[str], List[Optional[dict]]]:
+        """Chunk text and match the chunks against a previous output's manifest
+        
+        Returns the chunks, their hashes and, per chunk, the manifest entry
+        whose audio can be reused or None if it must be synthesized.
+        """
+        chunks = self.text_processor.chunk_text(text)
+        keys = [self.cache.make_key(chunk.text, voice_id, rate, pitch) for chunk in chunks]
+        reused = ChunkManifest.reusable(manifest, keys) if manifest else [None] * len(chunks)
+        return chunks, keys, reused
+    
+    async def process_document(self, chunks: Iterable[TextChunk], voice_id: str, rate: int, pitch: int,
+                               volume: int, pause: int, output_format: str = "mp3",
+                               max_concurrency: int = None, progress_callback=None,
+                               username: str = None, failed_chunks: list = None,
+                               effects: AudioEffects = None, total_characters: int = None):
+        """Synthesize a document's chunks while they are being read
+        
+        chunks is usually a DocumentReader.chunks() generator. A chunk is read
+        only when a synthesis slot frees up, so the document text is never
+        held in memory as a whole. Progress is reported against
+        total_characters when given; failures are handled as in
+        process_single_voice().
+        """
+        effects = effects or AudioEffects(volume=volume)
+        spans = []
+        read_characters = 0
+        
+        async def chunk_texts():
+            nonlocal read_characters
+            iterator = iter(chunks)
+            while True:
+                # Reading and parsing the document blocks, so it runs off the event loop
+                chunk = await asyncio.to_thread(next, iterator, None)
+                if chunk is None:
+                    return
+                spans.append((chunk.start, chunk.end))
+                read_characters += TextProcessor.count_characters(chunk.text)
+                yield chunk.text
+        
+        def report_chunk(done: int, total: int):
+            if progress_callback and total_characters:
+                percent = int(min(read_characters / total_characters, 1) * 90)
+                progress_callback(percent, f"Synthesized chunk {done}")
+        
+        failures = []
+        boundaries = {}
+        audio_results = await self.synthesize_sentences(
+            chunk_texts(), voice_id, rate, pitch, volume, max_concurrency, report_chunk,
+            failures, username, boundaries
+        )
+        
+        if failed_chunks is not None:
+            for failure in failures:
+                start, end = spans[failure["index"]]
+                failed_chunks.append({
+                    "index": failure["index"],
+                    "start": start,
+                    "end": end,
+                    "text": failure["text"],
+                    "error": failure["error"]
+                })
+        
+        if spans and len(failures) == len(spans):
+            raise SynthesisError(f"All {len(spans)} chunks failed: {failures[0]['error']}")
+        
+        if progress_callback:
+            progress_callback(90, "Combining audio...")
+        
+        kept = [index for index, audio_data in enumerate(audio_results) if audio_data]
+        return await self.write_output(
+            [audio_results[index] for index in kept], pause, output_format, username, "document",
+            effects, [boundaries.get(index, []) for index in kept]
+        )
+    
+    def save_manifest(self, audio_file: str, manifest: dict, username: str = None):
+        """Publish and register a chunk manifest next to audio_file"""
+        record = database.get_output_by_filename(os.path.basename(audio_file))
+        with self.job_temp_dir() as temp_dir:
+            temp_path = os.path.join(temp_dir, os.path.basename(ChunkManifest.path_for(audio_file)))
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            manifest_file = self.publish_output(temp_path, "single", os.path.dirname(audio_file))
+        database.register_output(f"{record['file_id']}_manifest", manifest_file, username, "json")
+    
+    async def write_output(self, segments: List[bytes], pause, output_format: str,
+                           username: str = None, prefix: str = "single",
+                           effects: AudioEffects = None, boundaries: List[list] = None,
+                           speakers: List[str] = None, segment_ranges: list = None) -> Optional[str]:
+        """Combine synthesized segments into a registered output file
+        
+        pause is one gap length or a list with the gap after each segment.
+        If boundaries holds each segment's word boundaries, .srt, .vtt and
+        .json timings are written and registered next to the audio.
+        If segment_ranges is given and the segments were spliced, the byte
+        range of each segment in the output is appended to it.
+        """
+        effects = effects if effects and effects.active else None
+        if not segments:
+            return None
+        
+        file_id = uuid.uuid4().hex
+        filename = f"{prefix}_voice_{file_id}.{output_format}"
+        
+        with self.job_temp_dir() as temp_dir:
+            temp_output = os.path.join(temp_dir, filename)
+            
+            # Fast path: splice edge-tts frames directly, no decode/re-encode.
+            # Effects need the PCM samples, so they always take the slow path.
+            spliced_ranges = None
+            if output_format == "mp3" and not effects:
+                spliced_ranges = await audio_executor.run(splice_mp3, segments, pause, temp_output)
+            spliced = spliced_ranges is not None
+            written = temp_output if spliced else None
+            if spliced and segment_ranges is not None:
+                segment_ranges.extend(spliced_ranges)
+            if not written:
+                written = await audio_executor.run(
+                    render_audio, segments, pause, temp_output, output_format, effects
+                )
+            if not written:
+                return None
+            
+            # Publish atomically so downloads and GC never see partial files
+            output_file = self.publish_output(temp_output, prefix)
+            
+            subtitle_files = []
+            if boundaries is not None:
+                try:
+                    timings = await audio_executor.run(
+                        SubtitleBuilder.build, segments, pause, spliced, boundaries, speakers
+                    )
+                    temp_base = os.path.splitext(temp_output)[0]
+                    for path in await audio_executor.run(write_subtitles, timings, temp_base):
+                        subtitle_files.append(
+                            self.publish_output(path, prefix, os.path.dirname(output_file))
+                        )
+                except Exception as e:
+                    print(f"Subtitle error: {str(e)}")
+        
+        database.register_output(file_id, output_file, username, output_format)
+        for path in subtitle_files:
+            subtitle_format = os.path.splitext(path)[1].lstrip(".")
+            database.register_output(f"{file_id}_{subtitle_format}", path, username, subtitle_format)
+        return output_file
+    
+    @contextmanager
+    def job_temp_dir(self):
+        """Private temp directory for one job, removed when the job ends"""
+        temp_dir = self.claim_temp_dir()
+        try:
+            yield temp_dir
+        finally:
+            self.release_temp_dir(temp_dir)
+    
+    def claim_temp_dir(self, prefix: str = "job") -> str:
+        """Create a temp directory that cleanup_temp_files() skips until it is released"""
+        temp_dir = os.path.join("temp", f"{prefix}_{uuid.uuid4().hex}")
+        self.active_temp_dirs.add(temp_dir)
+        os.makedirs(temp_dir, exist_ok=True)
+        return temp_dir
+    
+    def release_temp_dir(self, temp_dir: str):
+        """Remove a directory created by claim_temp_dir()"""
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        self.active_temp_dirs.discard(temp_dir)
+    
+    def publish_output(self, temp_path: str, prefix: str, output_dir: str = None) -> str:
+        """Move a finished file from a job temp directory into outputs/
+        
+        output_dir places it next to an already published file.
+        """
+        if not output_dir:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            output_dir = f"outputs/{prefix}_{timestamp}"
+        os.makedirs(output_dir, exist_ok=True)
+        output_file = os.path.join(output_dir, os.path.basename(temp_path))
+        os.replace(temp_path, output_file)
+        return output_file
+    
+    async def stream_single_voice(self, text: str, voice_id: str, rate: int, pitch: int,
+                                  pause: int, max_concurrency: int = None, username: str = None,
+                                  delivered: list = None):
+        """Yield MP3 data for text as soon as it is synthesized
+        
+        The first sentence is relayed chunk by chunk straight from edge-tts
+        while the following sentences are synthesized ahead concurrently and
+        emitted in order, separated by pre-encoded silent frames. At most
+        max_concurrency sentences are synthesized or buffered ahead, so
+        read-ahead follows the pace of the client.
+        Raises SynthesisError, ending the stream early, when a sentence cannot
+        be synthesized, rather than leaving a gap in the audio.
+        If delivered is given, each sentence is appended to it once all of its
+        audio has been yielded.
+        """
+        sentences = [chunk.text for chunk in self.text_processor.chunk_text(text)]
+        if not sentences:
+            return
+        
+        window = max(1, max_concurrency or self.max_concurrency)
+        semaphore = asyncio.Semaphore(window)
+        
+        async def prefetch(sentence: str):
+            async with semaphore:
+                try:
+                    return await self.generate_speech_with_retry(sentence, voice_id, rate, pitch, username=username)
+                except SynthesisError as e:
+                    # Returned rather than raised so it surfaces in stream order
+                    return e
+        
+        def fail(error: SynthesisError):
+            print(f"Error streaming speech: {str(error)}")
+            metrics.failed_sentences.inc(1, "stream")
+            return error
+        
+        pending = deque()
+        next_index = 1
+        
+        def refill():
+            nonlocal next_index
+            while next_index < len(sentences) and len(pending) < window:
+                sentence = sentences[next_index]
+                pending.append((sentence, asyncio.create_task(prefetch(sentence))))
+                next_index += 1
+        
+        silence = None
+        emitted = False
+        
+        try:
+            refill()
+            try:
+                # The first sentence takes a slot like any other, so at most
+                # window edge-tts sessions are open for this stream
+                async with semaphore:
+                    async for chunk in self.stream_speech(sentences[0], voice_id, rate, pitch, username):
+                        if silence is None:
+                            header = MP3Utils.find_header(chunk)
+                            silence = MP3Utils.silence(pause, header["header"] if header else None)
+                        emitted = True
+                        yield chunk
+                if delivered is not None:
+                    delivered.append(sentences[0])
+            except SynthesisError as e:
+                # Nothing has been sent yet, so the first sentence can still be retried whole
+                if emitted:
+                    raise fail(e)
+                print(f"Retrying first sentence after error: {str(e)}")
+                pending.appendleft((sentences[0], asyncio.create_task(prefetch(sentences[0]))))
+            
+            while pending:
+                sentence, task = pending.popleft()
+                audio_data = await task
+                refill()
+                if isinstance(audio_data, SynthesisError):
+                    raise fail(audio_data)
+                if silence is None:
+                    header = MP3Utils.find_header(audio_data)
+                    silence = MP3Utils.silence(pause, header["header"] if header else None)
+                if emitted:
+                    yield silence
+                emitted = True
+                yield audio_data
+                if delivered is not None:
+                    delivered.append(sentence)
+        finally:
+            for _, task in pending:
+                task.cancel()
+    
+    def cleanup_temp_files(self, max_age: int = None):
+        """Clean temporary files left behind by jobs older than max_age seconds
+        
+        Each job works in its own temp directory, and directories of running
+        jobs are skipped however old they are, so only abandoned ones are removed.
+        """
+        if max_age is None:
+            max_age = self.TEMP_MAX_AGE
+        cutoff = time.time() - max_age
+        active = {os.path.normpath(path) for path in list(self.active_temp_dirs)}
+        
+        try:
+            for path in glob.glob("temp/*"):
+                try:
+                    if os.path.normpath(path) in active or os.path.getmtime(path) > cutoff:
+                        continue
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+                except:
+                    pass
+        except Exception as e:
+            print(f"Error cleaning temp files: {str(e)}")
+
+# ==================== DIALOGUE PROCESSOR ====================
+class DialogueProcessor:
+    """Multi-voice scripts: speaker-tagged turns mapped to different voices"""
+    # "Speaker: text", also accepting the full-width colon used in CJK text
+    TURN_PATTERN = re.compile(r"^\s*([^:：\n]{1,40}?)\s*[:：]\s*(.+)$")
+    QA_ALIASES = {
+        "q": "Q", "question": "Q", "hỏi": "Q",
+        "a": "A", "answer": "A", "đáp": "A", "trả lời": "A"
+    }
+    
+    def __init__(self, processor: "TTSProcessor", text_processor: TextProcessor = None):
+        self.processor = processor
+        self.text_processor = text_processor or processor.text_processor
+    
+    def parse_script(self, text: str, speakers: Iterable[str], qa: bool = False) -> List[Tuple[str, str]]:
+        """Split a script into (speaker, text) turns
+        
+        Only tags naming one of speakers start a new turn, so lines such as
+        "Note: meeting at 10:30" continue the previous speaker like untagged
+        lines do. In Q&A mode the Q/A/Question/Answer tags are also
+        recognized and normalized to "Q" and "A".
+        """
+        speakers = set(speakers)
+        turns = []
+        speaker = None
+        
+        for line in self.text_processor.clean_text(text).split("\n"):
+            line = line.strip()
+            if not line:
+                continue
+            
+            match = self.TURN_PATTERN.match(line)
+            if match:
+                tag = match.group(1).strip()
+                if qa and tag not in speakers:
+                    tag = self.QA_ALIASES.get(tag.lower(), tag)
+                if tag in speakers or (qa and tag in self.QA_ALIASES.values()):
+                    speaker, line = tag, match.group(2).strip()
+            if speaker is None:
+                raise ValueError("Script must start with a speaker tag, e.g. 'Alice: Hello'")
+            turns.append((speaker, line))
+        
+        return turns
+    
+    @staticmethod
+    def turn_pauses(turns: List[Tuple[str, str]], pause: int, speaker_pause: int,
+                    speaker_pauses: Dict[str, int] = None) -> List[int]:
+        """Gap after each turn
+        
+        speaker_pauses overrides the gap after a given speaker; otherwise
+        speaker_pause is used when the speaker changes and pause when the
+        same speaker continues.
+        """
+        speaker_pauses = speaker_pauses or {}
+        gaps = []
+        for (speaker, _), (next_speaker, _) in zip(turns, turns[1:]):
+            if speaker in speaker_pauses:
+                gaps.append(int(speaker_pauses[speaker]))
+            elif speaker != next_speaker:
+                gaps.append(speaker_pause)
+            else:
+                gaps.append(pause)
+        return gaps
+    
+    async def process_dialogue(self, turns: List[Tuple[str, str]], voices: Dict[str, str], rate: int,
+                               pitch: int, volume: int, pause: int, speaker_pause: int,
+                               output_format: str = "mp3", speaker_pauses: Dict[str, int] = None,
+                               progress_callback=None, username: str = None,
+                               prefix: str = "multi", failed_chunks: list = None,
+                               effects: AudioEffects = None) -> Optional[str]:
+        """Synthesize all turns concurrently and assemble them in order
+        
+        Each turn is chunked like single-voice text. Chunks that could not be
+        synthesized are left out and, if failed_chunks is given, appended to
+        it. Raises SynthesisError if every chunk failed.
+        """
+        processor = self.processor
+        semaphore = asyncio.Semaphore(processor.max_concurrency)
+        
+        # Identical chunks for the same voice are synthesized only once
+        turn_chunks = [self.text_processor.chunk_text(line) for _, line in turns]
+        unique = {}
+        for (speaker, _), chunks in zip(turns, turn_chunks):
+            for chunk in chunks:
+                unique.setdefault((chunk.text, voices[speaker]), None)
+        
+        completed = 0
+        boundaries_by_key = {}
+        
+        async def synthesize(line: str, voice_id: str):
+            nonlocal completed
+            async with semaphore:
+                line_boundaries = boundaries_by_key.setdefault((line, voice_id), [])
+                try:
+                    result = await processor.generate_speech_with_retry(
+                        line, voice_id, rate, pitch, volume, username=username,
+                        boundaries=line_boundaries
+                    )
+                except SynthesisError as e:
+                    print(f"Dialogue chunk failed: {str(e)}")
+                    result = e
+            completed += 1
+            if progress_callback:
+                progress_callback(int(completed / len(unique) * 90), f"Synthesized chunk {completed}/{len(unique)}")
+            return result
+        
+        results = await asyncio.gather(*(synthesize(line, voice_id) for line, voice_id in unique))
+        audio_by_key = dict(zip(unique, results))
+        
+        if progress_callback:
+            progress_callback(90, "Combining audio...")
+        
+        gaps = self.turn_pauses(turns, pause, speaker_pause, speaker_pauses)
+        segments = []
+        kept_gaps = []
+        kept_boundaries = []
+        kept_speakers = []
+        failures = []
+        for index, (speaker, _) in enumerate(turns):
+            # Chunks within a turn are spliced with the plain pause, turns with their own gap
+            turn_started = False
+            for chunk in turn_chunks[index]:
+                key = (chunk.text, voices[speaker])
+                audio_data = audio_by_key[key]
+                if isinstance(audio_data, SynthesisError):
+                    failures.append({
+                        "index": index, "speaker": speaker, "start": chunk.start,
+                        "end": chunk.end, "text": chunk.text, "error": str(audio_data)
+                    })
+                    continue
+                if segments:
+                    kept_gaps.append(pause if turn_started else gaps[index - 1])
+                segments.append(audio_data)
+                kept_boundaries.append(boundaries_by_key[key])
+                kept_speakers.append(speaker)
+                turn_started = True
+        
+        if failed_chunks is not None:
+            failed_chunks.extend(failures)
+        if not segments and failures:
+            raise SynthesisError(f"All {len(failures)} chunks failed: {failures[0]['error']}")
+        
+        return await processor.write_output(
+            segments, kept_gaps, output_format, username, prefix, effects or AudioEffects(volume=volume),
+            kept_boundaries, kept_speakers
+        )
+
+# ==================== BATCH PROCESSOR ====================
+class BatchProcessor:
+    """Runs many single-voice items under one global concurrency limit"""
+    MAX_ITEMS = int(os.environ.get("TTS_BATCH_MAX_ITEMS", 500))
+    # Uploads share the document upload limit; ZIP members may inflate to at most this in total
+    MAX_UPLOAD_BYTES = DocumentReader.MAX_UPLOAD_BYTES
+    MAX_UNCOMPRESSED_BYTES = int(os.environ.get("TTS_BATCH_MAX_UNCOMPRESSED_BYTES", 200 * 1024 * 1024))
+    # Items synthesized at once across all batches
+    MAX_CONCURRENT_ITEMS = int(os.environ.get("TTS_BATCH_CONCURRENCY", 4))
+    
+    ITEM_DEFAULTS = {
+        "rate": 0,
+        "pitch": 0,
+        "volume": 100,
+        "pause": 500,
+        "output_format": "mp3",
+        "normalize": False,
+        "compress": False,
+        "fade_in": 0,
+        "fade_out": 0
+    }
+    
+    def __init__(self, processor: "TTSProcessor", max_concurrent_items: int = None):
+        self.processor = processor
+        self.max_concurrent_items = max(1, max_concurrent_items or self.MAX_CONCURRENT_ITEMS)
+        self.semaphore: Optional[asyncio.Semaphore] = None
+    
+    @classmethod
+    def normalize_items(cls, raw_items: list, defaults: dict = None) -> List[dict]:
+        """Validate batch items and fill in default parameters
+        
+        Raises ValueError describing the first invalid item.
+        """
+        if not isinstance(raw_items, list) or not raw_items:
+            raise ValueError("Batch must contain at least one item")
+        if len(raw_items) > cls.MAX_ITEMS:
+            raise ValueError(f"Batch is limited to {cls.MAX_ITEMS} items")
+        
+        items = []
+        seen_ids = set()
+        for index, raw in enumerate(raw_items):
+            if not isinstance(raw, dict):
+                raise ValueError(f"Item {index} must be an object")
+            item = {**cls.ITEM_DEFAULTS, **(defaults or {}), **raw}
+            if not str(item.get("text", "")).strip():
+                raise ValueError(f"Item {index} has no text")
+            if not item.get("voice_id"):
+                raise ValueError(f"Item {index} has no voice_id")
+            if not voice_catalog.has_voice(item["voice_id"]):
+                raise ValueError(f"Item {index} has unknown voice_id '{item['voice_id']}'")
+            if item["output_format"] not in TTSConfig.OUTPUT_FORMATS:
+                raise ValueError(f"Item {index} has unsupported output_format '{item['output_format']}'")
+            try:
+                for key in ("rate", "pitch", "volume", "pause", "fade_in", "fade_out"):
+                    item[key] = int(item[key])
+            except (TypeError, ValueError):
+                raise ValueError(f"Item {index} has a non-integer '{key}'")
+            for key in ("normalize", "compress"):
+                if isinstance(item[key], str):
+                    item[key] = item[key].lower() in ("1", "true", "yes", "on")
+            try:
+                item["effects"] = AudioEffects.from_params(
+                    item["volume"], item["normalize"], item["compress"], item["fade_in"], item["fade_out"]
+                )
+            except ValueError as e:
+                raise ValueError(f"Item {index}: {str(e)}")
+            item["text"] = str(item["text"])
+            # ids name the files inside the ZIP, so keep them safe and unique
+            item_id = re.sub(r"[^\w.-]", "_", str(item.get("id", index))).strip(".") or str(index)
+            if item_id in seen_ids:
+                item_id = f"{item_id}_{index}"
+            seen_ids.add(item_id)
+            item["id"] = item_id
+            items.append(item)
+        return items
+    
+    @classmethod
+    def parse_jsonl(cls, data: bytes) -> List[dict]:
+        """Parse JSON Lines into a list of objects"""
+        items = []
+        for line_number, line in enumerate(data.decode("utf-8-sig").splitlines(), 1):
+            if line.strip():
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    raise ValueError(f"Invalid JSON on line {line_number}")
+                if len(items) > cls.MAX_ITEMS:
+                    raise ValueError(f"Batch is limited to {cls.MAX_ITEMS} items")
+        return items
+    
+    @classmethod
+    def parse_zip(cls, data: bytes) -> List[dict]:
+        """Read items from the .jsonl and .txt members of a ZIP upload
+        
+        Each .txt member becomes one item using the batch defaults.
+        Raises ValueError before inflating anything if the members would
+        exceed MAX_UNCOMPRESSED_BYTES.
+        """
+        items = []
+        try:
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                members = [
+                    info for info in archive.infolist()
+                    if not info.is_dir() and not os.path.basename(info.filename).startswith(".")
+                    and info.filename.lower().endswith((".jsonl", ".txt"))
+                ]
+                # zipfile never inflates a member past its declared file_size
+                if sum(info.file_size for info in members) > cls.MAX_UNCOMPRESSED_BYTES:
+                    raise ValueError(
+                        f"ZIP contents exceed {cls.MAX_UNCOMPRESSED_BYTES // (1024 * 1024)} MB uncompressed"
+                    )
+                
+                for info in natsort.natsorted(members, key=lambda info: info.filename):
+                    if info.filename.lower().endswith(".jsonl"):
+                        items.extend(cls.parse_jsonl(archive.read(info)))
+                    else:
+                        text = archive.read(info).decode("utf-8-sig")
+                        items.append({"id": os.path.splitext(os.path.basename(info.filename))[0], "text": text})
+                    if len(items) > cls.MAX_ITEMS:
+                        raise ValueError(f"Batch is limited to {cls.MAX_ITEMS} items")
+        except zipfile.BadZipFile:
+            raise ValueError("Invalid ZIP file")
+        return items
+    
+    @classmethod
+    async def read_upload(cls, upload: UploadFile) -> bytes:
+        """Read a batch upload, raising ValueError if it exceeds MAX_UPLOAD_BYTES"""
+        data = await upload.read(cls.MAX_UPLOAD_BYTES + 1)
+        if len(data) > cls.MAX_UPLOAD_BYTES:
+            raise ValueError(f"File is larger than {cls.MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+        return data
+    
+    @classmethod
+    async def read_json_body(cls, request: Request):
+        """Parse a JSON request body, raising ValueError if it exceeds MAX_UPLOAD_BYTES"""
+        body = bytearray()
+        async for block in request.stream():
+            body.extend(block)
+            if len(body) > cls.MAX_UPLOAD_BYTES:
+                raise ValueError(f"Request body is larger than {cls.MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise ValueError("Invalid JSON body")
+    
+    async def run_item(self, item: dict, username: str) -> dict:
+        """Synthesize one batch item"""
+        failed_chunks = []
+        message = "Failed to generate audio"
+        async with self.semaphore:
+            try:
+                audio_file = await self.processor.process_single_voice(
+                    item["text"], item["voice_id"], item["rate"], item["pitch"],
+                    item["volume"], item["pause"], item["output_format"],
+                    username=username, failed_chunks=failed_chunks, effects=item["effects"]
+                )
+            except Exception as e:
+                print(f"Batch item {item['id']} failed: {str(e)}")
+                audio_file = None
+                if isinstance(e, SynthesisError):
+                    message = str(e)
+        
+        if not audio_file:
+            return {"id": item["id"], "success": False, "message": message, "failed_chunks": failed_chunks}
+        return {
+            "id": item["id"],
+            "success": True,
+            "audio_url": f"/download/{os.path.basename(audio_file)}",
+            **subtitle_urls(audio_file),
+            "path": audio_file,
+            "characters_used": TextProcessor.count_characters(item["text"]) - failed_characters(failed_chunks),
+            "failed_chunks": failed_chunks,
+            "message": generation_message(failed_chunks)
+        }
+    
+    async def process_batch(self, items: List[dict], username: str, make_zip: bool = False,
+                            progress_callback=None) -> dict:
+        """Run all items and return the batch manifest"""
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent_items)
+        
+        completed = 0
+        
+        async def run(item: dict):
+            nonlocal completed
+            result = await self.run_item(item, username)
+            completed += 1
+            if progress_callback:
+                progress_callback(int(completed / len(items) * 95), f"Processed item {completed}/{len(items)}")
+            return result
+        
+        results = await asyncio.gather(*(run(item) for item in items))
+        
+        manifest = {
+            "created_at": datetime.now().isoformat(),
+            "total": len(results),
+            "succeeded": sum(1 for result in results if result["success"]),
+            "items": [{k: v for k, v in result.items() if k != "path"} for result in results]
+        }
+        
+        batch_id = uuid.uuid4().hex
+        with self.processor.job_temp_dir() as temp_dir:
+            manifest_temp = os.path.join(temp_dir, f"batch_manifest_{batch_id}.json")
+            with open(manifest_temp, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=2, ensure_ascii=False)
+            manifest_file = self.processor.publish_output(manifest_temp, "batch")
+            database.register_output(f"manifest_{batch_id}", manifest_file, username, "json")
+            manifest_url = f"/download/{os.path.basename(manifest_file)}"
+            
+            zip_url = None
+            if make_zip and manifest["succeeded"]:
+                if progress_callback:
+                    progress_callback(95, "Packaging ZIP...")
+                members = []
+                for result in results:
+                    if not result["success"]:
+                        continue
+                    # Subtitle files share the audio's base name
+                    base_path, extension = os.path.splitext(result["path"])
+                    members.append((result["path"], f"{result['id']}{extension}"))
+                    for subtitle_extension in (".srt", ".vtt", ".json"):
+                        if os.path.exists(base_path + subtitle_extension):
+                            members.append((base_path + subtitle_extension, f"{result['id']}{subtitle_extension}"))
+                zip_temp = os.path.join(temp_dir, f"batch_{batch_id}.zip")
+                await audio_executor.run(build_zip, members, manifest, zip_temp)
+                zip_file = self.processor.publish_output(zip_temp, "batch")
+                database.register_output(batch_id, zip_file, username, "zip")
+                zip_url = f"/download/{os.path.basename(zip_file)}"
+        
+        return {
+            "success": manifest["succeeded"] > 0,
+            "message": f"{manifest['succeeded']}/{manifest['total']} items generated",
+            "manifest": manifest,
+            "manifest_url": manifest_url,
+            "zip_url": zip_url
+        }
+
+# ==================== OUTPUT GARBAGE COLLECTOR ====================
+class OutputGC:
+    """Background retention and disk-quota enforcement for outputs/"""
+    MAX_AGE_DAYS = float(os.environ.get("TTS_OUTPUT_MAX_AGE_DAYS", 7))
+    USER_QUOTA_BYTES = int(os.environ.get("TTS_OUTPUT_USER_QUOTA_BYTES", 500 * 1024 * 1024))
+    GLOBAL_QUOTA_BYTES = int(os.environ.get("TTS_OUTPUT_GLOBAL_QUOTA_BYTES", 5 * 1024 * 1024 * 1024))
+    INTERVAL = int(os.environ.get("TTS_OUTPUT_GC_INTERVAL", 3600))
+    
+    def __init__(self, db: Database, outputs_dir: str = "outputs"):
+        self.db = db
+        self.outputs_dir = outputs_dir
+        self.removed_files = 0
+        self.freed_bytes = 0
+        self.last_run = None
+    
+    def remove(self, record: dict):
+        """Delete an output file and its registry entry"""
+        try:
+            os.remove(record["path"])
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error removing {record['path']}: {str(e)}")
+            return
+        self.db.delete_output(record["file_id"])
+        self.removed_files += 1
+        self.freed_bytes += record["size"]
+    
+    def collect(self):
+        """Apply age, per-user and global limits, oldest files first"""
+        cutoff = datetime.now() - timedelta(days=self.MAX_AGE_DAYS)
+        for record in self.db.list_outputs(created_before=cutoff.isoformat()):
+            self.remove(record)
+        
+        for owner, total in self.db.output_bytes_by_owner().items():
+            if owner is None or total <= self.USER_QUOTA_BYTES:
+                continue
+            for record in self.db.list_outputs(owner=owner):
+                if total <= self.USER_QUOTA_BYTES:
+                    break
+                self.remove(record)
+                total -= record["size"]
+        
+        total = sum(self.db.output_bytes_by_owner().values())
+        if total > self.GLOBAL_QUOTA_BYTES:
+            for record in self.db.list_outputs():
+                if total <= self.GLOBAL_QUOTA_BYTES:
+                    break
+                self.remove(record)
+                total -= record["size"]
+        
+        self.remove_stray_files(cutoff.timestamp())
+        self.last_run = datetime.now().isoformat()
+    
+    def remove_stray_files(self, cutoff: float):
+        """Delete unregistered old files and old empty output directories"""
+        for root, dirs, files in os.walk(self.outputs_dir, topdown=False):
+            for filename in files:
+                path = os.path.join(root, filename)
+                try:
+                    if os.path.getmtime(path) < cutoff and not self.db.get_output_by_filename(filename):
+                        os.remove(path)
+                except OSError:
+                    pass
+            # Recent directories may be about to receive a file from publish_output()
+            if root != self.outputs_dir:
+                try:
+                    if os.path.getmtime(root) < cutoff:
+                        os.rmdir(root)
+                except OSError:
+                    pass
+    
+    async def run(self):
+        """Run collection every INTERVAL seconds"""
+        while True:
+            try:
+                await asyncio.to_thread(self.collect)
+                if tts_processor:
+                    await asyncio.to_thread(tts_processor.cleanup_temp_files)
+            except Exception as e:
+                print(f"Output GC error: {str(e)}")
+            await asyncio.sleep(self.INTERVAL)
+    
+    def stats(self) -> dict:
+        """Collector counters"""
+        return {
+            "removed_files": self.removed_files,
+            "freed_bytes": self.freed_bytes,
+            "last_run": self.last_run
+        }
+
+output_gc = OutputGC(database)
+
+# ==================== JOB MANAGER ====================
+class JobManager:
+    """In-process async job queue served by a pool of worker tasks"""
+    WORKERS = int(os.environ.get("TTS_JOB_WORKERS", 2))
+    # Seconds a finished task stays available to /api/task/{task_id}
+    RESULT_TTL = int(os.environ.get("TTS_JOB_TTL", 3600))
+    
+    def __init__(self, workers: int = None, result_ttl: int = None):
+        self.worker_count = max(1, workers or self.WORKERS)
+        self.result_ttl = result_ttl if result_ttl is not None else self.RESULT_TTL
+        self.tasks: Dict[str, dict] = {}
+        self.queue: Optional[asyncio.Queue] = None
+        self.workers: List[asyncio.Task] = []
+    
+    async def start(self):
+        """Start worker tasks and the expired-task reaper"""
+        self.queue = asyncio.Queue()
+        self.workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.worker_count)
+        ]
+        self.workers.append(asyncio.create_task(self._reaper()))
+    
+    async def stop(self):
+        """Cancel all worker tasks"""
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+    
+    def submit(self, username: str, handler, message: str = "Queued", kind: str = "job") -> str:
+        """Queue a job and return its task id
+        
+        handler is an async callable taking a progress callback
+        progress(percent, message) and returning the task result dict.
+        kind labels the job in metrics.
+        """
+        task_id = uuid.uuid4().hex
+        now = time.time()
+        self.tasks[task_id] = {
+            "task_id": task_id,
+            "username": username,
+            "kind": kind,
+            "status": "pending",
+            "progress": 0,
+            "message": message,
+            "result": None,
+            "created_at": now,
+            "updated_at": now,
+            "finished_at": None
+        }
+        self.queue.put_nowait((task_id, handler))
+        return task_id
+    
+    def get_task(self, task_id: str) -> Optional[dict]:
+        """Get task by id"""
+        return self.tasks.get(task_id)
+    
+    def update_task(self, task_id: str, progress: int = None, message: str = None):
+        """Update task progress"""
+        task = self.tasks.get(task_id)
+        if not task:
+            return
+        if progress is not None:
+            task["progress"] = max(0, min(100, int(progress)))
+        if message is not None:
+            task["message"] = message
+        task["updated_at"] = time.time()
+    
+    def queue_depth(self) -> int:
+        """Number of jobs waiting for a worker"""
+        return self.queue.qsize() if self.queue else 0
+    
+    async def _worker(self):
+        while True:
+            task_id, handler = await self.queue.get()
+            task = self.tasks.get(task_id)
+            try:
+                if not task:
+                    continue
+                task["status"] = "running"
+                self.update_task(task_id, 0, "Processing...")
+                
+                def progress(percent: int, message: str = None):
+                    self.update_task(task_id, percent, message)
+                
+                task["result"] = await handler(progress)
+                task["status"] = "completed"
+                self.update_task(task_id, 100, "Completed")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Task {task_id} failed: {str(e)}")
+                task["status"] = "failed"
+                task["result"] = {"success": False, "message": str(e)}
+                self.update_task(task_id, message=str(e))
+            finally:
+                if task:
+                    task["finished_at"] = time.time()
+                    metrics.job_seconds.observe(
+                        task["finished_at"] - task["created_at"], task["kind"], task["status"]
+                    )
+                self.queue.task_done()
+    
+    async def _reaper(self):
+        while True:
+            await asyncio.sleep(60)
+            cutoff = time.time() - self.result_ttl
+            expired = [
+                task_id for task_id, task in self.tasks.items()
+                if task["finished_at"] and task["finished_at"] < cutoff
+            ]
+            for task_id in expired:
+                self.tasks.pop(task_id, None)
+
+job_manager = JobManager()
+
+# ==================== LIFESPAN MANAGER ====================
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Lifespan event handler"""
+    print("Starting up TTS Generator with User Management...")
+    
+    global tts_processor, dialogue_processor, batch_processor
+    tts_processor = TTSProcessor()
+    dialogue_processor = DialogueProcessor(tts_processor)
+    batch_processor = BatchProcessor(tts_processor)
+    
+    # Nothing is running yet, so every leftover temp file is stale
+    tts_processor.cleanup_temp_files(max_age=0)
+    
+    # Create template files
+    create_template_files()
+    
+    audio_executor.start()
+    await job_manager.start()
+    session_flusher = asyncio.create_task(session_cache.run_flusher())
+    gc_task = asyncio.create_task(output_gc.run())
+    # Serve the bundled snapshot until the live voice list has loaded
+    voice_refresher = asyncio.create_task(voice_catalog.run_refresher())
+    
+    yield
+    
+    print("Shutting down TTS Generator...")
+    await job_manager.stop()
+    session_flusher.cancel()
+    gc_task.cancel()
+    voice_refresher.cancel()
+    session_cache.flush()
+    audio_executor.shutdown()
+    tts_processor.cleanup_temp_files(max_age=0)
+
+# ==================== FASTAPI APPLICATION ====================
+app = FastAPI(
+    title="Professional TTS Generator with User Management", 
     version="3.0.0",
     lifespan=lifespan
 )
 
-# Global instance
+# Global instances, created in lifespan()
 tts_processor = None
+dialogue_processor = None
+batch_processor = None
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -974,6 +4316,122 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # Templates
 templates = Jinja2Templates(directory="templates")
 
+# ==================== FILE RESPONSES ====================
+MEDIA_TYPES = {
+    "mp3": "audio/mpeg",
+    "wav": "audio/wav",
+    "ogg": "audio/ogg",
+    "srt": "application/x-subrip",
+    "vtt": "text/vtt",
+    "json": "application/json",
+    "zip": "application/zip"
+}
+
+def parse_range_header(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single-range Range header into inclusive (start, end)
+    
+    Returns None when the header should be ignored and raises ValueError
+    when the range cannot be satisfied.
+    """
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        # Multipart ranges are optional; serve the whole file instead
+        return None
+    
+    start_str, _, end_str = ranges.strip().partition("-")
+    try:
+        if not start_str:
+            length = int(end_str)
+            if length <= 0:
+                raise ValueError("Empty suffix range")
+            start, end = max(0, size - length), size - 1
+        else:
+            start = int(start_str)
+            end = int(end_str) if end_str else size - 1
+    except ValueError:
+        raise ValueError("Malformed range")
+    
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+def iter_file_range(path: str, start: int, end: int, block_size: int = 64 * 1024):
+    """Yield bytes start..end (inclusive) of a file"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+def etag_matches(request: Request, quoted_etag: str) -> bool:
+    """Whether the request's If-None-Match covers quoted_etag"""
+    if_none_match = request.headers.get("if-none-match") if request else None
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or quoted_etag in candidates
+
+def build_json_response(request: Request, body: bytes, etag: str, cache_control: str = "no-cache"):
+    """Serve pre-serialized JSON with an ETag, answering 304 when it matches"""
+    quoted_etag = f'"{etag}"'
+    headers = {"ETag": quoted_etag, "Cache-Control": cache_control}
+    if etag_matches(request, quoted_etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+def build_file_response(request: Request, path: str, filename: str, output_format: str, etag: str):
+    """Serve a generated file with conditional GET and byte-range support"""
+    size = os.path.getsize(path)
+    quoted_etag = f'"{etag}"'
+    headers = {
+        "ETag": quoted_etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, no-cache"
+    }
+    media_type = MEDIA_TYPES.get(output_format, "application/octet-stream")
+    
+    if etag_matches(request, quoted_etag):
+        return Response(status_code=304, headers=headers)
+    
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == quoted_etag):
+        try:
+            byte_range = parse_range_header(range_header, size)
+        except ValueError:
+            return Response(
+                status_code=416,
+                headers={**headers, "Content-Range": f"bytes */{size}"}
+            )
+        
+        if byte_range:
+            start, end = byte_range
+            metrics.bytes_served.inc(end - start + 1, "download")
+            return StreamingResponse(
+                iter_file_range(path, start, end),
+                status_code=206,
+                media_type=media_type,
+                headers={
+                    **headers,
+                    "Content-Range": f"bytes {start}-{end}/{size}",
+                    "Content-Length": str(end - start + 1)
+                }
+            )
+    
+    metrics.bytes_served.inc(size, "download")
+    return FileResponse(
+        path,
+        filename=filename,
+        media_type=media_type,
+        headers=headers,
+        content_disposition_type="inline"
+    )
+
 # ==================== SIMPLE ROUTES ====================
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
@@ -992,153 +4450,676 @@ async def login(username: str = Form(...), password: str = Form(...)):
         user_data = database.authenticate_user(username, password)
         if not user_data:
             return JSONResponse(
-                {"success": False, "message": "Invalid username or password"},
-                status_code=401
+                {"success": False, "message": "Invalid username or password"},
+                status_code=401
+            )
+        
+        session_token = database.create_session(username)
+        
+        response = JSONResponse({
+            "success": True,
+            "message": "Login successful",
+            "user": {
+                "username": user_data["username"],
+                "full_name": user_data.get("full_name", ""),
+                "role": user_data["role"]
+            }
+        })
+        
+        response.set_cookie(
+            key="session_token",
+            value=session_token,
+            httponly=True,
+            max_age=86400,
+            secure=False,
+            samesite="lax"
+        )
+        
+        return response
+        
+    except Exception as e:
+        print(f"Login error: {str(e)}")
+        return JSONResponse(
+            {"success": False, "message": f"Login error: {str(e)}"},
+            status_code=500
+        )
+
+@app.get("/register", response_class=HTMLResponse)
+async def register_page(request: Request):
+    """Register page"""
+    return templates.TemplateResponse("register.html", {"request": request})
+
+@app.post("/api/register")
+async def register(
+    username: str = Form(...),
+    password: str = Form(...),
+    email: str = Form(...),
+    full_name: str = Form("")
+):
+    """Register API"""
+    try:
+        if len(password) < 6:
+            return JSONResponse(
+                {"success": False, "message": "Password must be at least 6 characters"},
+                status_code=400
+            )
+        
+        success, message = database.create_user(username, password, email, full_name)
+        if not success:
+            return JSONResponse(
+                {"success": False, "message": message},
+                status_code=400
+            )
+        
+        return JSONResponse({"success": True, "message": message})
+        
+    except Exception as e:
+        print(f"Registration error: {str(e)}")
+        return JSONResponse(
+            {"success": False, "message": f"Registration error: {str(e)}"},
+            status_code=500
+        )
+
+@app.get("/logout")
+async def logout(request: Request):
+    """Logout"""
+    session_token = request.cookies.get("session_token")
+    if session_token:
+        session_cache.forget(session_token)
+        database.delete_session(session_token)
+    
+    response = RedirectResponse("/")
+    response.delete_cookie("session_token")
+    return response
+
+@app.get("/dashboard", response_class=HTMLResponse)
+async def dashboard(request: Request):
+    """Dashboard page"""
+    try:
+        user = await get_current_user(request)
+        if not user:
+            return RedirectResponse("/login")
+        
+        # Calculate usage percentage
+        subscription = user["subscription"]
+        usage = user["usage"]
+        
+        if subscription["plan"] == "free":
+            usage_percentage = (usage["characters_used"] / subscription["characters_limit"]) * 100
+            usage_text = f"{usage['characters_used']:,}/{subscription['characters_limit']:,} characters this week"
+        else:
+            usage_percentage = 0
+            usage_text = f"{usage['characters_used']:,} characters used"
+        
+        return templates.TemplateResponse("dashboard.html", {
+            "request": request,
+            "user": user,
+            "usage_percentage": min(usage_percentage, 100),
+            "usage_text": usage_text,
+            "subscription_plans": TTSConfig.SUBSCRIPTION_PLANS
+        })
+        
+    except Exception as e:
+        print(f"Dashboard error: {str(e)}")
+        return RedirectResponse("/login")
+
+@app.get("/tts", response_class=HTMLResponse)
+async def tts_page(request: Request):
+    """TTS page"""
+    try:
+        user = await get_current_user(request)
+        if not user:
+            return RedirectResponse("/login")
+        
+        can_access, message = database.can_user_use_feature(user["username"], "single")
+        
+        return templates.TemplateResponse("tts.html", {
+            "request": request,
+            "user": user,
+            "languages": voice_catalog.languages,
+            "formats": TTSConfig.OUTPUT_FORMATS,
+            "can_access": can_access,
+            "access_message": message if not can_access else ""
+        })
+        
+    except Exception as e:
+        print(f"TTS page error: {str(e)}")
+        return RedirectResponse("/login")
+
+@app.post("/api/generate/single")
+async def generate_single_voice(
+    request: Request,
+    text: str = Form(...),
+    voice_id: str = Form(...),
+    rate: int = Form(0),
+    pitch: int = Form(0),
+    volume: int = Form(100),
+    pause: int = Form(500),
+    output_format: str = Form("mp3"),
+    normalize: bool = Form(False),
+    compress: bool = Form(False),
+    fade_in: int = Form(0),
+    fade_out: int = Form(0)
+):
+    """Generate single voice TTS
+    
+    normalize, compress, fade_in and fade_out (ms) post-process the output.
+    """
+    try:
+        user = await get_current_user(request)
+        if not user:
+            return JSONResponse(
+                {"success": False, "message": "Not authenticated"},
+                status_code=401
+            )
+        
+        if not voice_catalog.has_voice(voice_id):
+            return JSONResponse(
+                {"success": False, "message": f"Unknown voice '{voice_id}'"},
+                status_code=400
+            )
+        
+        try:
+            effects = AudioEffects.from_params(volume, normalize, compress, fade_in, fade_out)
+        except ValueError as e:
+            return JSONResponse(
+                {"success": False, "message": str(e)},
+                status_code=400
+            )
+        
+        # Count characters
+        characters_used = TextProcessor.count_characters(text)
+        
+        # Check access and hold the characters until the job settles
+        reservation_id, message = usage_ledger.reserve(user["username"], "single", characters_used)
+        if not reservation_id:
+            return JSONResponse(
+                {"success": False, "message": message},
+                status_code=403
+            )
+        
+        async def run_job(progress):
+            failed_chunks = []
+            try:
+                audio_file = await tts_processor.process_single_voice(
+                    text, voice_id, rate, pitch, volume, pause, output_format,
+                    progress_callback=progress, username=user["username"],
+                    failed_chunks=failed_chunks, effects=effects
+                )
+                if not audio_file:
+                    raise Exception("Failed to generate audio")
+            except BaseException:
+                usage_ledger.refund(reservation_id)
+                raise
+            
+            # Characters of chunks that failed are refunded
+            charged = usage_ledger.commit(reservation_id, characters_used - failed_characters(failed_chunks))
+            
+            return {
+                "success": True,
+                "audio_url": f"/download/{os.path.basename(audio_file)}",
+                **subtitle_urls(audio_file),
+                "characters_used": charged,
+                "failed_chunks": failed_chunks,
+                "message": generation_message(failed_chunks)
+            }
+        
+        # Generate audio in the background
+        task_id = job_manager.submit(user["username"], run_job, kind="single")
+        
+        return JSONResponse({
+            "success": True,
+            "task_id": task_id,
+            "characters_used": characters_used,
+            "message": "Task queued"
+        })
+            
+    except Exception as e:
+        print(f"Generation error: {str(e)}")
+        return JSONResponse(
+            {"success": False, "message": f"Generation error: {str(e)}"},
+            status_code=500
+        )
+
+@app.post("/api/generate/regenerate")
+async def regenerate_single_voice(
+    request: Request,
+    filename: str = Form(...),
+    text: str = Form(...)
+):
+    """Regenerate a single voice output for edited text
+    
+    filename is the audio file to update. Its voice and settings are kept,
+    and only chunks whose text changed are synthesized and charged; the
+    rest are spliced in from the existing audio.
+    """
+    try:
+        user = await get_current_user(request)
+        if not user:
+            return JSONResponse(
+                {"success": False, "message": "Not authenticated"},
+                status_code=401
+            )
+        
+        record = database.get_output_by_filename(filename)
+        if record and record["owner"] != user["username"] and user["role"] != "admin":
+            record = None
+        manifest = ChunkManifest.load(record["path"]) if record and os.path.exists(record["path"]) else None
+        if not manifest:
+            return JSONResponse(
+                {"success": False, "message": "No regenerable output with that name"},
+                status_code=404
+            )
+        
+        chunks, _, reused = tts_processor.plan_chunks(
+            text, manifest["voice_id"], manifest["rate"], manifest["pitch"], manifest
+        )
+        # Only the chunks that must be synthesized are charged
+        characters_used = sum(
+            TextProcessor.count_characters(chunk.text) for chunk, entry in zip(chunks, reused) if not entry
+        )
+        
+        reservation_id, message = usage_ledger.reserve(user["username"], "single", characters_used)
+        if not reservation_id:
+            return JSONResponse(
+                {"success": False, "message": message},
+                status_code=403
+            )
+        
+        async def run_job(progress):
+            failed_chunks = []
+            try:
+                audio_file = await tts_processor.process_single_voice(
+                    text, manifest["voice_id"], manifest["rate"], manifest["pitch"], manifest["volume"],
+                    manifest["pause"], manifest["output_format"],
+                    progress_callback=progress, username=user["username"],
+                    failed_chunks=failed_chunks, effects=AudioEffects(**manifest["effects"]),
+                    previous=(record["path"], manifest)
+                )
+                if not audio_file:
+                    raise Exception("Failed to generate audio")
+            except BaseException:
+                usage_ledger.refund(reservation_id)
+                raise
+            
+            charged = usage_ledger.commit(reservation_id, characters_used - failed_characters(failed_chunks))
+            
+            return {
+                "success": True,
+                "audio_url": f"/download/{os.path.basename(audio_file)}",
+                **subtitle_urls(audio_file),
+                "characters_used": charged,
+                "reused_chunks": sum(1 for entry in reused if entry),
+                "synthesized_chunks": sum(1 for entry in reused if not entry),
+                "failed_chunks": failed_chunks,
+                "message": generation_message(failed_chunks)
+            }
+        
+        task_id = job_manager.submit(user["username"], run_job, kind="regenerate")
+        
+        return JSONResponse({
+            "success": True,
+            "task_id": task_id,
+            "characters_used": characters_used,
+            "message": "Task queued"
+        })
+            
+    except Exception as e:
+        print(f"Regeneration error: {str(e)}")
+        return JSONResponse(
+            {"success": False, "message": f"Regeneration error: {str(e)}"},
+            status_code=500
+        )
+
+@app.post("/api/generate/upload")
+async def generate_from_upload(
+    request: Request,
+    file: UploadFile = File(...),
+    voice_id: str = Form(...),
+    rate: int = Form(0),
+    pitch: int = Form(0),
+    volume: int = Form(100),
+    pause: int = Form(500),
+    output_format: str = Form("mp3"),
+    normalize: bool = Form(False),
+    compress: bool = Form(False),
+    fade_in: int = Form(0),
+    fade_out: int = Form(0)
+):
+    """Generate single voice TTS from an uploaded .txt, .docx or .epub document
+    
+    The upload is spooled to disk and read incrementally while it is
+    synthesized, so large documents are never loaded as one string.
+    """
+    try:
+        user = await get_current_user(request)
+        if not user:
+            return JSONResponse(
+                {"success": False, "message": "Not authenticated"},
+                status_code=401
+            )
+        
+        if not voice_catalog.has_voice(voice_id):
+            return JSONResponse(
+                {"success": False, "message": f"Unknown voice '{voice_id}'"},
+                status_code=400
+            )
+        
+        try:
+            effects = AudioEffects.from_params(volume, normalize, compress, fade_in, fade_out)
+        except ValueError as e:
+            return JSONResponse(
+                {"success": False, "message": str(e)},
+                status_code=400
+            )
+        
+        extension = os.path.splitext(file.filename or "")[1].lower()
+        if extension not in DocumentReader.FORMATS:
+            return JSONResponse(
+                {"success": False, "message": "Upload a .txt, .docx or .epub file"},
+                status_code=400
             )
         
-        session_token = database.create_session(username)
+        # The job outlives the request, so it reads from its own copy of the upload
+        upload_dir = tts_processor.claim_temp_dir("upload")
+        document_path = os.path.join(upload_dir, f"document{extension}")
+        try:
+            await asyncio.to_thread(DocumentReader.save_upload, file.file, document_path)
+            characters_used = await audio_executor.run(DocumentReader.count_characters, document_path)
+        except ValueError as e:
+            tts_processor.release_temp_dir(upload_dir)
+            return JSONResponse(
+                {"success": False, "message": str(e)},
+                status_code=400
+            )
         
-        response = JSONResponse({
-            "success": True,
-            "message": "Login successful",
-            "user": {
-                "username": user_data["username"],
-                "full_name": user_data.get("full_name", ""),
-                "role": user_data["role"]
-            }
-        })
+        if not characters_used:
+            tts_processor.release_temp_dir(upload_dir)
+            return JSONResponse(
+                {"success": False, "message": "No text found in the document"},
+                status_code=400
+            )
         
-        response.set_cookie(
-            key="session_token",
-            value=session_token,
-            httponly=True,
-            max_age=86400,
-            secure=False,
-            samesite="lax"
-        )
+        reservation_id, message = usage_ledger.reserve(user["username"], "single", characters_used)
+        if not reservation_id:
+            tts_processor.release_temp_dir(upload_dir)
+            return JSONResponse(
+                {"success": False, "message": message},
+                status_code=403
+            )
         
-        return response
+        async def run_job(progress):
+            failed_chunks = []
+            try:
+                audio_file = await tts_processor.process_document(
+                    DocumentReader.chunks(document_path), voice_id, rate, pitch, volume, pause,
+                    output_format, progress_callback=progress, username=user["username"],
+                    failed_chunks=failed_chunks, effects=effects, total_characters=characters_used
+                )
+                if not audio_file:
+                    raise Exception("Failed to generate audio")
+            except BaseException:
+                usage_ledger.refund(reservation_id)
+                raise
+            finally:
+                tts_processor.release_temp_dir(upload_dir)
+            
+            charged = usage_ledger.commit(reservation_id, characters_used - failed_characters(failed_chunks))
+            
+            return {
+                "success": True,
+                "audio_url": f"/download/{os.path.basename(audio_file)}",
+                **subtitle_urls(audio_file),
+                "characters_used": charged,
+                "failed_chunks": failed_chunks,
+                "message": generation_message(failed_chunks)
+            }
         
+        task_id = job_manager.submit(user["username"], run_job, kind="document")
+        
+        return JSONResponse({
+            "success": True,
+            "task_id": task_id,
+            "characters_used": characters_used,
+            "message": "Task queued"
+        })
+            
     except Exception as e:
-        print(f"Login error: {str(e)}")
+        print(f"Upload generation error: {str(e)}")
         return JSONResponse(
-            {"success": False, "message": f"Login error: {str(e)}"},
+            {"success": False, "message": f"Generation error: {str(e)}"},
             status_code=500
         )
 
-@app.get("/register", response_class=HTMLResponse)
-async def register_page(request: Request):
-    """Register page"""
-    return templates.TemplateResponse("register.html", {"request": request})
-
-@app.post("/api/register")
-async def register(
-    username: str = Form(...),
-    password: str = Form(...),
-    email: str = Form(...),
-    full_name: str = Form("")
+@app.post("/api/generate/stream")
+async def generate_single_voice_stream(
+    request: Request,
+    text: str = Form(...),
+    voice_id: str = Form(...),
+    rate: int = Form(0),
+    pitch: int = Form(0),
+    pause: int = Form(500)
 ):
-    """Register API"""
+    """Stream single voice TTS as MP3 while it is being synthesized"""
     try:
-        if len(password) < 6:
+        user = await get_current_user(request)
+        if not user:
             return JSONResponse(
-                {"success": False, "message": "Password must be at least 6 characters"},
+                {"success": False, "message": "Not authenticated"},
+                status_code=401
+            )
+        
+        if not voice_catalog.has_voice(voice_id):
+            return JSONResponse(
+                {"success": False, "message": f"Unknown voice '{voice_id}'"},
                 status_code=400
             )
         
-        success, message = database.create_user(username, password, email, full_name)
-        if not success:
+        characters_used = TextProcessor.count_characters(text)
+        
+        reservation_id, message = usage_ledger.reserve(user["username"], "single", characters_used)
+        if not reservation_id:
             return JSONResponse(
                 {"success": False, "message": message},
-                status_code=400
+                status_code=403
             )
         
-        return JSONResponse({"success": True, "message": message})
+        async def stream_and_settle():
+            # Charge only sentences whose audio was fully sent; failures and
+            # anything left unsent after a disconnect are refunded
+            delivered = []
+            try:
+                async for chunk in tts_processor.stream_single_voice(
+                    text, voice_id, rate, pitch, pause, username=user["username"], delivered=delivered
+                ):
+                    metrics.bytes_served.inc(len(chunk), "stream")
+                    yield chunk
+            finally:
+                if delivered:
+                    usage_ledger.commit(
+                        reservation_id, sum(TextProcessor.count_characters(sentence) for sentence in delivered)
+                    )
+                else:
+                    usage_ledger.refund(reservation_id)
+        
+        return StreamingResponse(
+            stream_and_settle(),
+            media_type="audio/mpeg",
+            headers={
+                "Cache-Control": "no-store",
+                # Stop reverse proxies from buffering the whole response
+                "X-Accel-Buffering": "no"
+            }
+        )
         
     except Exception as e:
-        print(f"Registration error: {str(e)}")
+        print(f"Streaming error: {str(e)}")
         return JSONResponse(
-            {"success": False, "message": f"Registration error: {str(e)}"},
+            {"success": False, "message": f"Streaming error: {str(e)}"},
             status_code=500
         )
 
-@app.get("/logout")
-async def logout(request: Request):
-    """Logout"""
-    session_token = request.cookies.get("session_token")
-    if session_token:
-        database.delete_session(session_token)
+async def submit_dialogue(request: Request, feature: str, text: str, voices: str, rate: int, pitch: int,
+                          volume: int, pause: int, speaker_pause: int, speaker_pauses: str,
+                          output_format: str, normalize: bool = False, compress: bool = False,
+                          fade_in: int = 0, fade_out: int = 0):
+    """Validate and queue a multi-voice or Q&A dialogue job"""
+    user = await get_current_user(request)
+    if not user:
+        return JSONResponse(
+            {"success": False, "message": "Not authenticated"},
+            status_code=401
+        )
     
-    response = RedirectResponse("/")
-    response.delete_cookie("session_token")
-    return response
-
-@app.get("/dashboard", response_class=HTMLResponse)
-async def dashboard(request: Request):
-    """Dashboard page"""
     try:
-        user = await get_current_user(request)
-        if not user:
-            return RedirectResponse("/login")
+        voice_map = json.loads(voices)
+        pause_map = json.loads(speaker_pauses) if speaker_pauses else {}
+        if not isinstance(voice_map, dict) or not isinstance(pause_map, dict):
+            raise ValueError("voices and speaker_pauses must be JSON objects")
+        try:
+            pause_map = {speaker: int(gap) for speaker, gap in pause_map.items()}
+        except (TypeError, ValueError):
+            raise ValueError("speaker_pauses values must be pause lengths in ms")
+        if any(gap < 0 for gap in pause_map.values()):
+            raise ValueError("speaker_pauses values must not be negative")
         
-        # Calculate usage percentage
-        subscription = user["subscription"]
-        usage = user["usage"]
+        turns = dialogue_processor.parse_script(text, voice_map, qa=feature == "qa")
+        if not turns:
+            raise ValueError("Script is empty")
         
-        if subscription["plan"] == "free":
-            usage_percentage = (usage["characters_used"] / subscription["characters_limit"]) * 100
-            usage_text = f"{usage['characters_used']:,}/{subscription['characters_limit']:,} characters this week"
-        else:
-            usage_percentage = 0
-            usage_text = f"{usage['characters_used']:,} characters used"
+        unmapped = sorted({speaker for speaker, _ in turns if not voice_map.get(speaker)})
+        if unmapped:
+            raise ValueError(f"No voice selected for: {', '.join(unmapped)}")
+        unknown = sorted({voice_map[speaker] for speaker, _ in turns if not voice_catalog.has_voice(voice_map[speaker])})
+        if unknown:
+            raise ValueError(f"Unknown voice: {', '.join(unknown)}")
+        if output_format not in TTSConfig.OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported output format '{output_format}'")
+        effects = AudioEffects.from_params(volume, normalize, compress, fade_in, fade_out)
+    except ValueError as e:
+        return JSONResponse(
+            {"success": False, "message": str(e)},
+            status_code=400
+        )
+    
+    characters_used = sum(TextProcessor.count_characters(line) for _, line in turns)
+    reservation_id, message = usage_ledger.reserve(user["username"], feature, characters_used)
+    if not reservation_id:
+        return JSONResponse(
+            {"success": False, "message": message},
+            status_code=403
+        )
+    
+    async def run_job(progress):
+        failed_chunks = []
+        try:
+            audio_file = await dialogue_processor.process_dialogue(
+                turns, voice_map, rate, pitch, volume, pause, speaker_pause, output_format,
+                speaker_pauses=pause_map, progress_callback=progress,
+                username=user["username"], prefix=feature, failed_chunks=failed_chunks,
+                effects=effects
+            )
+            if not audio_file:
+                raise Exception("Failed to generate audio")
+        except BaseException:
+            usage_ledger.refund(reservation_id)
+            raise
         
-        return templates.TemplateResponse("dashboard.html", {
-            "request": request,
-            "user": user,
-            "usage_percentage": min(usage_percentage, 100),
-            "usage_text": usage_text,
-            "subscription_plans": TTSConfig.SUBSCRIPTION_PLANS
-        })
+        charged = usage_ledger.commit(reservation_id, characters_used - failed_characters(failed_chunks))
         
-    except Exception as e:
-        print(f"Dashboard error: {str(e)}")
-        return RedirectResponse("/login")
+        return {
+            "success": True,
+            "audio_url": f"/download/{os.path.basename(audio_file)}",
+            **subtitle_urls(audio_file),
+            "characters_used": charged,
+            "turns": len(turns),
+            "failed_chunks": failed_chunks,
+            "message": generation_message(failed_chunks)
+        }
+    
+    task_id = job_manager.submit(user["username"], run_job, kind=feature)
+    
+    return JSONResponse({
+        "success": True,
+        "task_id": task_id,
+        "characters_used": characters_used,
+        "message": "Task queued"
+    })
 
-@app.get("/tts", response_class=HTMLResponse)
-async def tts_page(request: Request):
-    """TTS page"""
+@app.post("/api/generate/multi")
+async def generate_multi_voice(
+    request: Request,
+    text: str = Form(...),
+    voices: str = Form(...),
+    rate: int = Form(0),
+    pitch: int = Form(0),
+    volume: int = Form(100),
+    pause: int = Form(300),
+    speaker_pause: int = Form(700),
+    speaker_pauses: str = Form(""),
+    output_format: str = Form("mp3"),
+    normalize: bool = Form(False),
+    compress: bool = Form(False),
+    fade_in: int = Form(0),
+    fade_out: int = Form(0)
+):
+    """Generate multi-voice TTS from a speaker-tagged script
+    
+    voices is a JSON object mapping speaker names to voice ids.
+    """
     try:
-        user = await get_current_user(request)
-        if not user:
-            return RedirectResponse("/login")
-        
-        can_access, message = database.can_user_use_feature(user["username"], "single")
-        
-        return templates.TemplateResponse("tts.html", {
-            "request": request,
-            "user": user,
-            "languages": TTSConfig.LANGUAGES,
-            "formats": TTSConfig.OUTPUT_FORMATS,
-            "can_access": can_access,
-            "access_message": message if not can_access else ""
-        })
-        
+        return await submit_dialogue(
+            request, "multi", text, voices, rate, pitch, volume, pause,
+            speaker_pause, speaker_pauses, output_format, normalize, compress, fade_in, fade_out
+        )
     except Exception as e:
-        print(f"TTS page error: {str(e)}")
-        return RedirectResponse("/login")
+        print(f"Multi-voice error: {str(e)}")
+        return JSONResponse(
+            {"success": False, "message": f"Generation error: {str(e)}"},
+            status_code=500
+        )
 
-@app.post("/api/generate/single")
-async def generate_single_voice(
+@app.post("/api/generate/qa")
+async def generate_qa_dialogue(
     request: Request,
     text: str = Form(...),
-    voice_id: str = Form(...),
+    voices: str = Form(...),
     rate: int = Form(0),
     pitch: int = Form(0),
     volume: int = Form(100),
-    pause: int = Form(500),
-    output_format: str = Form("mp3")
+    pause: int = Form(300),
+    speaker_pause: int = Form(700),
+    speaker_pauses: str = Form(""),
+    output_format: str = Form("mp3"),
+    normalize: bool = Form(False),
+    compress: bool = Form(False),
+    fade_in: int = Form(0),
+    fade_out: int = Form(0)
 ):
-    """Generate single voice TTS"""
+    """Generate a Q&A dialogue from a script tagged with Q:/A: lines
+    
+    voices is a JSON object with "Q" and "A" voice ids.
+    """
+    try:
+        return await submit_dialogue(
+            request, "qa", text, voices, rate, pitch, volume, pause,
+            speaker_pause, speaker_pauses, output_format, normalize, compress, fade_in, fade_out
+        )
+    except Exception as e:
+        print(f"Q&A error: {str(e)}")
+        return JSONResponse(
+            {"success": False, "message": f"Generation error: {str(e)}"},
+            status_code=500
+        )
+
+@app.post("/api/generate/batch")
+async def generate_batch(request: Request):
+    """Generate many single voice items in one submission
+    
+    Accepts either a JSON body (a list of items, or {"items": [...], "zip": true})
+    or a multipart upload with a .jsonl/.zip "file" plus optional default
+    form fields (voice_id, rate, pitch, volume, pause, output_format, zip).
+    """
     try:
         user = await get_current_user(request)
         if not user:
@@ -1147,42 +5128,108 @@ async def generate_single_voice(
                 status_code=401
             )
         
-        # Count characters
-        characters_used = TextProcessor.count_characters(text)
+        content_type = request.headers.get("content-type", "")
+        try:
+            if content_type.startswith("application/json"):
+                payload = await BatchProcessor.read_json_body(request)
+                if isinstance(payload, dict):
+                    raw_items = payload.get("items")
+                    defaults = payload.get("defaults") or {}
+                    make_zip = bool(payload.get("zip", False))
+                else:
+                    raw_items, defaults, make_zip = payload, {}, False
+            else:
+                form = await request.form()
+                upload = form.get("file")
+                if upload is None or isinstance(upload, str):
+                    raise ValueError("Upload a .jsonl or .zip file")
+                data = await BatchProcessor.read_upload(upload)
+                if upload.filename.lower().endswith(".zip"):
+                    raw_items = BatchProcessor.parse_zip(data)
+                else:
+                    raw_items = BatchProcessor.parse_jsonl(data)
+                defaults = {
+                    key: form[key] for key in ("voice_id", *BatchProcessor.ITEM_DEFAULTS) if form.get(key)
+                }
+                make_zip = str(form.get("zip", "")).lower() in ("1", "true", "yes", "on")
+            
+            items = BatchProcessor.normalize_items(raw_items, defaults)
+        except ValueError as e:
+            return JSONResponse(
+                {"success": False, "message": str(e)},
+                status_code=400
+            )
         
-        # Check if user can use the feature
-        can_access, message = database.can_user_use_feature(user["username"], "single")
-        if not can_access:
+        characters_used = sum(TextProcessor.count_characters(item["text"]) for item in items)
+        
+        reservation_id, message = usage_ledger.reserve(user["username"], "single", characters_used)
+        if not reservation_id:
             return JSONResponse(
                 {"success": False, "message": message},
                 status_code=403
             )
         
-        # Record usage
-        database.record_usage(user["username"], characters_used)
+        async def run_job(progress):
+            try:
+                result = await batch_processor.process_batch(items, user["username"], make_zip, progress)
+            except BaseException:
+                usage_ledger.refund(reservation_id)
+                raise
+            
+            # Only items that produced audio are charged
+            result["characters_used"] = usage_ledger.commit(reservation_id, sum(
+                item["characters_used"] for item in result["manifest"]["items"] if item["success"]
+            ))
+            return result
+        
+        task_id = job_manager.submit(user["username"], run_job, kind="batch")
+        
+        return JSONResponse({
+            "success": True,
+            "task_id": task_id,
+            "items": len(items),
+            "characters_used": characters_used,
+            "message": "Batch queued"
+        })
         
-        # Generate audio
-        audio_file = await tts_processor.process_single_voice(
-            text, voice_id, rate, pitch, volume, pause, output_format
+    except Exception as e:
+        print(f"Batch error: {str(e)}")
+        return JSONResponse(
+            {"success": False, "message": f"Batch error: {str(e)}"},
+            status_code=500
         )
+
+@app.get("/api/task/{task_id}")
+async def get_task_status(task_id: str, request: Request):
+    """Get background task status"""
+    try:
+        user = await get_current_user(request)
+        if not user:
+            return JSONResponse(
+                {"success": False, "message": "Not authenticated"},
+                status_code=401
+            )
+        
+        task = job_manager.get_task(task_id)
+        if not task or (task["username"] != user["username"] and user["role"] != "admin"):
+            return JSONResponse(
+                {"success": False, "message": "Task not found"},
+                status_code=404
+            )
+        
+        return JSONResponse({
+            "success": True,
+            "task_id": task_id,
+            "status": task["status"],
+            "progress": task["progress"],
+            "message": task["message"],
+            "result": task["result"]
+        })
         
-        if audio_file:
-            return JSONResponse({
-                "success": True,
-                "audio_url": f"/download/{os.path.basename(audio_file)}",
-                "characters_used": characters_used,
-                "message": "Audio generated successfully"
-            })
-        else:
-            return JSONResponse({
-                "success": False,
-                "message": "Failed to generate audio"
-            })
-            
     except Exception as e:
-        print(f"Generation error: {str(e)}")
+        print(f"Get task error: {str(e)}")
         return JSONResponse(
-            {"success": False, "message": f"Generation error: {str(e)}"},
+            {"success": False, "message": f"Error: {str(e)}"},
             status_code=500
         )
 
@@ -1197,11 +5244,11 @@ async def download_file(filename: str, request: Request):
                 status_code=401
             )
         
-        file_path = None
-        for root, dirs, files in os.walk("outputs"):
-            if filename in files:
-                file_path = os.path.join(root, filename)
-                break
+        record = database.get_output_by_filename(filename)
+        if record and record["owner"] != user["username"] and user["role"] != "admin":
+            record = None
+        
+        file_path = record["path"] if record else None
         
         if not file_path or not os.path.exists(file_path):
             return JSONResponse(
@@ -1209,11 +5256,8 @@ async def download_file(filename: str, request: Request):
                 status_code=404
             )
         
-        return FileResponse(
-            file_path,
-            filename=filename,
-            media_type="application/octet-stream"
-        )
+        etag = await asyncio.to_thread(database.ensure_output_etag, record)
+        return build_file_response(request, file_path, filename, record["format"], etag)
         
     except Exception as e:
         print(f"Download error: {str(e)}")
@@ -1263,8 +5307,8 @@ async def get_languages(request: Request):
                 status_code=401
             )
         
-        languages = list(TTSConfig.LANGUAGES.keys())
-        return JSONResponse({"languages": languages})
+        body, etag = voice_catalog.languages_response()
+        return build_json_response(request, body, etag, "private, no-cache")
         
     except Exception as e:
         print(f"Get languages error: {str(e)}")
@@ -1274,25 +5318,14 @@ async def get_languages(request: Request):
         )
 
 @app.get("/api/voices")
-async def get_voices(language: str = None, request: Request = None):
-    """Get available voices"""
+async def get_voices(language: str = None, locale: str = None, gender: str = None, request: Request = None):
+    """Get available voices, optionally filtered by language, locale and gender
+    
+    Public so the page can load voices before login.
+    """
     try:
-        # Allow this endpoint to be accessed without authentication for initial page load
-        if request:
-            user = await get_current_user(request)
-            if not user:
-                # Still return voices for public access
-                pass
-        
-        if language and language in TTSConfig.LANGUAGES:
-            voices = TTSConfig.LANGUAGES[language]
-        else:
-            # Return all voices
-            voices = []
-            for lang_voices in TTSConfig.LANGUAGES.values():
-                voices.extend(lang_voices)
-        
-        return JSONResponse({"voices": voices})
+        body, etag = voice_catalog.voices_response(language, locale, gender)
+        return build_json_response(request, body, etag, "public, max-age=300")
         
     except Exception as e:
         print(f"Get voices error: {str(e)}")
@@ -1304,7 +5337,56 @@ async def get_voices(language: str = None, request: Request = None):
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return JSONResponse({"status": "healthy", "timestamp": datetime.now().isoformat()})
+    return JSONResponse({
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "synthesis_cache": tts_processor.cache.stats() if tts_processor else None,
+        "edge_tts_breaker": tts_processor.breaker.stats() if tts_processor else None,
+        "outbound_scheduler": outbound_scheduler.stats(),
+        "usage_ledger": usage_ledger.stats(),
+        "voice_catalog": voice_catalog.stats(),
+        "audio_executor": audio_executor.stats(),
+        "output_gc": output_gc.stats()
+    })
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Metrics in Prometheus text exposition format"""
+    lines = metrics.render()
+    
+    cache_stats = tts_processor.cache.stats() if tts_processor else {}
+    lines += render_metric("tts_synthesis_cache_hits_total", "Synthesis cache hits",
+                           cache_stats.get("hits", 0), "counter")
+    lines += render_metric("tts_synthesis_cache_misses_total", "Synthesis cache misses",
+                           cache_stats.get("misses", 0), "counter")
+    lines += render_metric("tts_synthesis_cache_hit_ratio", "Share of sentence lookups served from cache",
+                           cache_stats.get("hit_rate", 0))
+    lines += render_metric("tts_synthesis_cache_bytes", "Bytes held in the synthesis cache",
+                           cache_stats.get("bytes", 0))
+    
+    lines += render_metric("tts_job_queue_depth", "Jobs waiting for a worker", job_manager.queue_depth())
+    lines += render_metric("tts_jobs", "Tracked jobs by status", [
+        ([("status", status)], sum(1 for task in list(job_manager.tasks.values()) if task["status"] == status))
+        for status in ("pending", "running", "completed", "failed")
+    ])
+    
+    scheduler_stats = outbound_scheduler.stats()
+    lines += render_metric("tts_active_synthesis", "edge-tts sessions currently open", scheduler_stats["active"])
+    lines += render_metric("tts_outbound_waiting", "Synthesis requests waiting for an edge-tts slot",
+                           scheduler_stats["waiting"])
+    lines += render_metric("tts_edge_tts_circuit_open", "1 while the edge-tts circuit breaker rejects calls",
+                           int(bool(tts_processor) and tts_processor.breaker.state != "closed"))
+    
+    executor_stats = audio_executor.stats()
+    lines += render_metric("tts_audio_executor_pending", "Audio tasks submitted and not yet finished",
+                           executor_stats["pending"])
+    lines += render_metric("tts_audio_executor_queue_depth", "Audio tasks waiting for a worker",
+                           executor_stats["queue_depth"])
+    
+    lines += render_metric("tts_usage_reserved_characters", "Characters held by unsettled reservations",
+                           usage_ledger.stats()["reserved_characters"])
+    
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
 
 # ==================== TEMPLATE CREATION ====================
 def create_template_files():
@@ -1896,9 +5978,17 @@ def create_template_files():
                     body: formData
                 });
                 
-                const result = await response.json();
+                const submitted = await response.json();
                 
-                if (result.success) {
+                if (!submitted.success) {
+                    showMessage(submitted.message || 'Generation failed', 'danger');
+                    return;
+                }
+                
+                showMessage('Generating audio...', 'info');
+                const result = await waitForTask(submitted.task_id);
+                
+                if (result && result.success) {
                     showMessage('Audio generated successfully!', 'success');
                     
                     // Show audio player
@@ -1913,13 +6003,30 @@ def create_template_files():
                     // Show result section
                     document.getElementById('result').style.display = 'block';
                 } else {
-                    showMessage(result.message || 'Generation failed', 'danger');
+                    showMessage((result && result.message) || 'Generation failed', 'danger');
                 }
             } catch (error) {
                 showMessage('Network error. Please try again.', 'danger');
             }
         });
         
+        // Poll a background task until it finishes
+        async function waitForTask(taskId) {
+            while (true) {
+                await new Promise(resolve => setTimeout(resolve, 1000));
+                const response = await fetch(`/api/task/${taskId}`);
+                const task = await response.json();
+                
+                if (!task.success) {
+                    return task;
+                }
+                if (task.status === 'completed' || task.status === 'failed') {
+                    return task.result;
+                }
+                showMessage(`${task.message} (${task.progress}%)`, 'info');
+            }
+        }
+        
         // Event listeners
         document.getElementById('language').addEventListener('change', function() {
             loadVoices(this.value);